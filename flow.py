@@ -1,5 +1,7 @@
+import argparse
 import json
 import os
+import time
 
 import pandas as pd
 import yaml
@@ -7,10 +9,17 @@ import yaml
 from prefect import flow
 from prefect.states import Cancelled
 
-from src.pipeline.clients import get_db_client, get_minio_client
+from src.pipeline.autotune import BatchAutotuner
+from src.pipeline.clients import get_db_listener, get_db_pool, get_minio_client
 from src.pipeline.extract import (
+    claim_checkpoint,
     download_files, 
+    ensure_checkpoint_schema,
+    ensure_notify_trigger,
+    fetch_files,
     get_checkpoint,
+    get_high_water_mark,
+    get_worker_id,
     build_mount_paths
 )
 from src.pipeline.load import (
@@ -18,12 +27,392 @@ from src.pipeline.load import (
     db_insert_image_results,
     db_insert_model_config,
     db_insert_pollinator_predictions,
+    db_release_claims,
+    db_update_checkpoint,
 )
 from src.pipeline.transform import (
     model_predict,
+    n_rows,
     process_flower_predictions,
     process_pollinator_predictions,
 )
+from src.pipeline.pipelining import run_pipelined
+from src.pipeline.workers import model_predict_parallel
+
+
+def _task_callable(task, in_flow_context: bool = True):
+    """
+    Returns the task itself within the flow context, else its underlying function.
+    Prefect tasks cannot be called from the threads of the streaming pipeline.
+    """
+    return task if in_flow_context else task.fn
+
+
+def load_predictions(
+    conn: object,
+    data: pd.DataFrame,
+    flower_predictions: dict,
+    pollinator_predictions: dict,
+    model_config: dict,
+    allow_multiple_results: bool = False,
+    db_schema: str = None,
+    is_test: bool = False,
+    in_flow_context: bool = True
+):
+    """
+    Post-processes the model outputs of one batch and inserts them into the DB.
+
+    Parameters
+    ----------
+    conn : object
+        psycopg2 database client
+
+    data : pd.DataFrame
+        checkpoint dataframe of the batch
+
+    flower_predictions : dict
+        column-wise flower predictions from model_predict
+
+    pollinator_predictions : dict
+        column-wise pollinator predictions from model_predict
+
+    model_config : dict
+        model configuration
+
+    allow_multiple_results : bool, optional
+        if True allows multiple results per image with equal configuration, by default False
+
+    db_schema : str, optional
+        defines the database schema to use, by default None
+
+    is_test : bool, optional
+        if True writes intermediate results to local files, by default False
+
+    in_flow_context : bool, optional
+        False if called outside of the flow context (pipeline threads), by default True
+    """
+    # Insert image results and get back result_ids
+    result_ids = _task_callable(db_insert_image_results, in_flow_context)(
+        conn=conn,
+        data=data,
+        model_config=model_config,
+        allow_multiple_results=allow_multiple_results,
+        db_schema=db_schema
+    )
+    data["result_id"] = result_ids
+
+    if is_test:
+        data.to_csv("checkpoint_df.csv", index=False)
+        # Post-process flower predictions output
+        # write results to json if flow run is for test purpose
+        with open("flower_predictions.json", "w") as json_file:
+            json.dump({k: v.tolist() for k, v in flower_predictions.items()}, json_file)
+        with open("pollinator_predictions.json", "w") as json_file:
+            json.dump({k: v.tolist() for k, v in pollinator_predictions.items()}, json_file)
+
+    if n_rows(flower_predictions) > 0:
+        # Flower predictions pre-processing and ingestion
+        flower_predictions = _task_callable(process_flower_predictions, in_flow_context)(
+            flower_predictions=flower_predictions,
+            result_ids=data,
+            model_config=model_config
+        )
+        if is_test:
+            flower_predictions.to_csv('flower_predictions.csv', index=False)
+
+        flower_ids = _task_callable(db_insert_flower_predictions, in_flow_context)(
+            conn=conn, 
+            data=flower_predictions,
+            db_schema=db_schema
+        )
+        # Append IDs to flower predictions
+        flower_predictions["flower_id"] = flower_ids
+        if n_rows(pollinator_predictions) > 0:
+
+            # Pollinator predictions pre-processing and ingestion
+            pollinator_predictions = _task_callable(process_pollinator_predictions, in_flow_context)(
+                pollinator_predictions=pollinator_predictions,
+                flower_predictions=flower_predictions,
+                model_config=model_config
+            )
+            if is_test:
+                pollinator_predictions.to_csv('pollinator_predictions.csv', index=False)
+
+            _task_callable(db_insert_pollinator_predictions, in_flow_context)(
+                conn=conn, 
+                data=pollinator_predictions,
+                db_schema=db_schema
+            )
+    else:
+        print("No Flowers or Pollinators predicted")
+
+
+def run_etl_batch(
+    db_pool: object,
+    conn: object,
+    minio_client: object,
+    config: dict,
+    model_config: dict,
+    batch_size: int = 64,
+    n_workers: int = 1,
+    torch_threads: int = None,
+    is_test: bool = False,
+    multi_results_for_image: bool = False,
+    use_fs_mount: bool = False,
+    streaming: bool = False,
+    stream_chunksize: int = 16,
+    stream_queue_size: int = 2,
+    in_memory: bool = False,
+    max_buffer_mb: int = 512,
+    use_high_water_mark: bool = True,
+    high_water_mark_lag: int = 1000,
+    n_decode_workers: int = 4,
+    use_claims: bool = False,
+    claim_lease_seconds: int = 900,
+    ensure_schema: bool = True,
+    file_ids: list = None,
+    download_threads: int = 8,
+    autotuner: BatchAutotuner = None
+) -> int:
+    """
+    Extracts, transforms and loads one batch of unprocessed images. Has to be called within a flow,
+    the parameters are described in etl_flow.
+
+    Parameters
+    ----------
+    db_pool : object
+        DB connection pool, the load stage of the streaming mode takes its own connection from it
+
+    conn : object
+        psycopg2 connection taken from db_pool
+
+    minio_client : object
+        minio client, None if use_fs_mount
+
+    config : dict
+        configuration (source_config.yaml)
+
+    model_config : dict
+        model configuration (model_config.json)
+
+    ensure_schema : bool, optional
+        if True creates the checkpoint indexes and tables if not exist, by default True
+
+    file_ids : list, optional
+        if given only these files are processed (if not processed yet) instead of the next
+        files of the checkpoint query, by default None
+
+    download_threads : int, optional
+        threads downloading the objects from minio, by default 8
+
+    autotuner : BatchAutotuner, optional
+        if given, batch size and download threads are taken from it and the throughput of the
+        stages is recorded to it, by default None
+
+    Returns
+    -------
+    int
+        number of images loaded into the DB, 0 if there was no new data or none of the requested
+        images could be processed (e.g. deferred)
+    """
+    if ensure_schema:
+        # Creates checkpoint indexes and tables if not exist
+        ensure_checkpoint_schema(
+            conn=conn,
+            db_schema=config['DB_SCHEMA'],
+            use_high_water_mark=use_high_water_mark,
+            use_claims=use_claims
+        )
+
+    # -----------------------------------------------
+    # Extract
+    # -----------------------------------------------
+    # Extract objects to be processed
+    if autotuner is not None:
+        batch_size = autotuner.batch_size
+        download_threads = autotuner.n_threads
+    worker_id = get_worker_id()
+    if use_claims:
+        # leases the files, concurrent workers get disjoint batches
+        df_ckp = claim_checkpoint(
+            conn=conn,
+            request_batch_size=batch_size,
+            model_config_id=model_config["config_id"],
+            worker_id=worker_id,
+            lease_seconds=claim_lease_seconds,
+            db_schema=config['DB_SCHEMA'],
+            use_high_water_mark=use_high_water_mark,
+            file_ids=file_ids,
+            high_water_mark_lag=high_water_mark_lag
+        )
+    else:
+        df_ckp = get_checkpoint(
+            conn=conn,
+            request_batch_size=batch_size,
+            model_config_id=model_config["config_id"],
+            db_schema=config['DB_SCHEMA'],
+            use_high_water_mark=use_high_water_mark,
+            file_ids=file_ids,
+            high_water_mark_lag=high_water_mark_lag
+        )
+    print(f"Processing {df_ckp.shape[0]} datapoints.")
+
+    if df_ckp.shape[0] == 0:
+        return 0
+
+    if autotuner is not None:
+        autotuner.start_batch()
+
+    # Inserts model config if not exists
+    db_insert_model_config(
+        conn=conn, 
+        model_config=model_config,
+        db_schema=config['DB_SCHEMA']
+    )
+
+    def _record(stage: str, started_at: float, items: int, n_bytes: int = 0):
+        if autotuner is not None:
+            autotuner.record(stage, time.perf_counter() - started_at, items, n_bytes)
+
+    def _extract(data: pd.DataFrame) -> tuple:
+        started_at = time.perf_counter()
+        buffers = None
+        if use_fs_mount:
+            # transforms column object_name to show the exact name of the object 
+            # in the mounted filesystem 
+            data = _task_callable(build_mount_paths, not streaming)(
+                data=data,
+                mount_path=config["FS_MOUNT_PATH"],
+            )
+        elif in_memory:
+            # streams files from s3 into memory
+            buffers, deferred = _task_callable(fetch_files, not streaming)(
+                client=minio_client,
+                bucket_name=config["MINIO_BUCKET_NAME"],
+                filenames=data["object_name"].to_list(),
+                n_threads=download_threads,
+                max_bytes=max_buffer_mb * 1024 * 1024,
+            )
+            # deferred files stay unprocessed and are picked up by the next run
+            data = data[~data["object_name"].isin(deferred)].reset_index(drop=True)
+            _record("download", started_at, len(buffers), sum(len(buffer) for buffer in buffers.values()))
+        else:
+            # downloads file from s3
+            _task_callable(download_files, not streaming)(
+                client=minio_client,
+                bucket_name=config["MINIO_BUCKET_NAME"],
+                filenames=data["object_name"].to_list(),
+                n_threads=download_threads,
+            )
+            filenames = [filename for filename in data["object_name"] if os.path.exists(filename)]
+            _record("download", started_at, len(filenames), sum(os.path.getsize(filename) for filename in filenames))
+        return data, buffers
+
+    def _transform(inputs: tuple) -> tuple:
+        started_at = time.perf_counter()
+        data, buffers = inputs
+        if n_workers > 1:
+            # shards of the batch run in a pool of worker processes
+            flower_predictions, pollinator_predictions = _task_callable(model_predict_parallel, not streaming)(
+                data=data,
+                cfg=model_config,
+                n_workers=n_workers,
+                yolov5_path=config.get("YOLOV5_PATH"),
+                buffers=buffers,
+                torch_threads=torch_threads,
+                n_decode_workers=n_decode_workers
+            )
+        else:
+            flower_predictions, pollinator_predictions = _task_callable(model_predict, not streaming)(
+                data=data, 
+                cfg=model_config,
+                yolov5_path=config.get("YOLOV5_PATH"),
+                buffers=buffers,
+                n_decode_workers=n_decode_workers
+            )
+        _record("inference", started_at, data.shape[0])
+        return data, flower_predictions, pollinator_predictions
+
+    # file_ids inserted into image_results, to advance the high-water mark
+    loaded_file_ids = []
+
+    def _load(outputs: tuple, load_conn: object):
+        started_at = time.perf_counter()
+        data, flower_predictions, pollinator_predictions = outputs
+        n_results = data.shape[0] + n_rows(flower_predictions) + n_rows(pollinator_predictions)
+        load_predictions(
+            conn=load_conn,
+            data=data,
+            flower_predictions=flower_predictions,
+            pollinator_predictions=pollinator_predictions,
+            model_config=model_config,
+            allow_multiple_results=multi_results_for_image,
+            db_schema=config['DB_SCHEMA'],
+            is_test=is_test and not streaming,
+            in_flow_context=not streaming
+        )
+        loaded_file_ids.extend(data["file_id"].to_list())
+        _record("load", started_at, n_results)
+
+    try:
+        if streaming:
+            # -----------------------------------------------
+            # Extract, Transform and Load of consecutive chunks run concurrently
+            # -----------------------------------------------
+            chunks = [
+                df_ckp.iloc[start:start + stream_chunksize].reset_index(drop=True)
+                for start in range(0, df_ckp.shape[0], stream_chunksize)
+            ]
+            # the load stage uses its own connection of the pool
+            with db_pool.connection() as load_conn:
+                run_pipelined(
+                    items=chunks,
+                    stages=[_extract, _transform, lambda outputs: _load(outputs, load_conn)],
+                    max_queue_size=stream_queue_size
+                )
+        else:
+            # -----------------------------------------------
+            # Extract
+            # -----------------------------------------------
+            extracted = _extract(df_ckp)
+            # -----------------------------------------------
+            # Transform and Load
+            # -----------------------------------------------
+            _load(_transform(extracted), conn)
+    finally:
+        if use_claims:
+            # unprocessed files of the batch can be claimed again right away
+            db_release_claims(
+                conn=conn,
+                model_config_id=model_config["config_id"],
+                worker_id=worker_id,
+                file_ids=df_ckp["file_id"].to_list(),
+                db_schema=config['DB_SCHEMA']
+            )
+
+    # advance the high-water mark up to the first file which was not processed
+    high_water_mark = get_high_water_mark(
+        requested_file_ids=df_ckp["file_id"].to_list(),
+        processed_file_ids=loaded_file_ids
+    )
+    if use_high_water_mark and high_water_mark is not None:
+        db_update_checkpoint(
+            conn=conn,
+            model_config_id=model_config["config_id"],
+            last_file_id=high_water_mark,
+            db_schema=config['DB_SCHEMA'],
+            # batches of concurrent workers or notified files are not contiguous,
+            # stop at the first unprocessed file
+            verify=use_claims or file_ids is not None
+        )
+
+    if autotuner is not None:
+        autotuner.end_batch(df_ckp.shape[0])
+
+    if len(loaded_file_ids) < df_ckp.shape[0]:
+        print(f"{df_ckp.shape[0] - len(loaded_file_ids)} of {df_ckp.shape[0]} datapoints were not processed.")
+
+    return len(loaded_file_ids)
 
 
 @flow(
@@ -32,11 +421,38 @@ from src.pipeline.transform import (
 )
 def etl_flow(
     BATCHSIZE=64,
+    N_WORKERS=1,
+    TORCH_THREADS=None,
     CONFIG_PATH="source_config.yaml",
     MODEL_CONFIG_PATH="model_config.json",
     IS_TEST=False,
     MULTI_RESULTS_FOR_IMAGE=False,
-    USE_FS_MOUNT=False
+    USE_FS_MOUNT=False,
+    STREAMING=False,
+    STREAM_CHUNKSIZE=16,
+    STREAM_QUEUE_SIZE=2,
+    IN_MEMORY=False,
+    MAX_BUFFER_MB=512,
+    USE_HIGH_WATER_MARK=True,
+    HIGH_WATER_MARK_LAG=1000,
+    DECODE_WORKERS=4,
+    USE_CLAIMS=False,
+    CLAIM_LEASE_SECONDS=900,
+    DAEMON=False,
+    POLL_MIN_SECONDS=5,
+    POLL_MAX_SECONDS=300,
+    MAX_BATCHES=None,
+    MAX_IDLE_SECONDS=None,
+    LISTEN=False,
+    RECONCILE_SECONDS=600,
+    MAX_CONSECUTIVE_ERRORS=5,
+    DOWNLOAD_THREADS=8,
+    AUTOTUNE=False,
+    MIN_BATCHSIZE=8,
+    MAX_BATCHSIZE=512,
+    MAX_DOWNLOAD_THREADS=32,
+    AUTOTUNE_WINDOW=3,
+    METRICS_PATH=None
 ):
     """
     This function represents a flow implemented with prefect. A flow includes multiple smaller prefect task.
@@ -47,6 +463,13 @@ def etl_flow(
     BATCHSIZE : int, optional
         batch size which shall be processed at a time, by default 64
 
+    N_WORKERS : int, optional
+        number of inference worker processes, each one holds its own models and processes a shard
+        of the batch. The results are identical to a single process, by default 1
+
+    TORCH_THREADS : int, optional
+        torch intra-op threads per worker process, by default the CPU cores divided by N_WORKERS
+
     CONFIG_PATH : str, optional
         path to the configuration file (yaml-file), by default "source_config.yaml"
 
@@ -63,18 +486,110 @@ def etl_flow(
     USE_FS_MOUNT : bool, optional
         if true uses local mounted file system instead of minio bucket to load data, by default False
 
+    STREAMING : bool, optional
+        if true splits the batch into chunks of STREAM_CHUNKSIZE and overlaps download, inference and
+        DB insertion of consecutive chunks. Test outputs (IS_TEST) are only written without streaming,
+        by default False
+
+    STREAM_CHUNKSIZE : int, optional
+        number of images per chunk in streaming mode, by default 16
+
+    STREAM_QUEUE_SIZE : int, optional
+        maximum number of chunks waiting in front of each stage in streaming mode, by default 2
+
+    IN_MEMORY : bool, optional
+        if true streams the objects from the minio bucket into memory instead of downloading them
+        to the local filesystem, by default False
+
+    MAX_BUFFER_MB : int, optional
+        memory budget for the objects fetched in memory per batch (per chunk in streaming mode).
+        Objects exceeding it are deferred to the next flow run, by default 512
+
+    USE_HIGH_WATER_MARK : bool, optional
+        if true the checkpoint query only scans files after the persisted high-water mark of the
+        model configuration, which is advanced after every run. If false the whole table is scanned,
+        by default True
+
+    HIGH_WATER_MARK_LAG : int, optional
+        number of file_ids below the high-water mark which are scanned again, so files whose insert
+        committed after the high-water mark passed their file_id are still processed, by default 1000
+
+    DECODE_WORKERS : int, optional
+        threads decoding the next images while the current batch is in the model, by default 4
+
+    USE_CLAIMS : bool, optional
+        if true the files of a batch are leased to this worker, so multiple flow runs (on one or
+        more hosts) can process disjoint batches concurrently, by default False
+
+    CLAIM_LEASE_SECONDS : int, optional
+        duration of a lease, files of a crashed worker are claimed again afterwards. Has to be
+        longer than processing one batch, by default 900
+
+    DAEMON : bool, optional
+        if true processes batch after batch within this flow run, the models, DB connections and
+        the minio client stay warm and the high-water mark is persisted after every batch. While
+        there is no new data it polls with a backoff from POLL_MIN_SECONDS to POLL_MAX_SECONDS,
+        by default False
+
+    POLL_MIN_SECONDS : float, optional
+        first polling interval of the daemon mode once there is no new data, by default 5
+
+    POLL_MAX_SECONDS : float, optional
+        maximum polling interval of the daemon mode, by default 300
+
+    MAX_BATCHES : int, optional
+        stops the daemon mode after this many batches, by default None (no limit)
+
+    MAX_IDLE_SECONDS : float, optional
+        stops the daemon mode after this long without new data, by default None (no limit)
+
+    LISTEN : bool, optional
+        daemon mode only. Creates a trigger on files_image which notifies the file_ids of new rows
+        and processes exactly the notified files instead of polling. The checkpoint query only runs
+        as reconciliation sweep at start, every RECONCILE_SECONDS and after a lost connection,
+        by default False
+
+    RECONCILE_SECONDS : float, optional
+        interval of the reconciliation sweeps with LISTEN, by default 600
+
+    MAX_CONSECUTIVE_ERRORS : int, optional
+        daemon mode only. A failed batch (e.g. lost DB connection, minio timeout) is logged and
+        retried after the polling backoff, the daemon stops after this many failed batches in a row,
+        by default 5
+
+    DOWNLOAD_THREADS : int, optional
+        threads downloading the objects from minio, by default 8
+
+    AUTOTUNE : bool, optional
+        if true adjusts the batch size (between MIN_BATCHSIZE and MAX_BATCHSIZE) and the download
+        threads (up to MAX_DOWNLOAD_THREADS) to the throughput measured over the last AUTOTUNE_WINDOW
+        full batches, starting at BATCHSIZE and DOWNLOAD_THREADS. With IN_MEMORY (without STREAMING)
+        the batch size is also bounded by MAX_BUFFER_MB, by default False
+
+    MIN_BATCHSIZE : int, optional
+        lower bound of the batch size with AUTOTUNE, by default 8
+
+    MAX_BATCHSIZE : int, optional
+        upper bound of the batch size with AUTOTUNE, by default 512
+
+    MAX_DOWNLOAD_THREADS : int, optional
+        upper bound of the download threads with AUTOTUNE, by default 32
+
+    AUTOTUNE_WINDOW : int, optional
+        number of full batches measured before each adjustment with AUTOTUNE, by default 3
+
+    METRICS_PATH : str, optional
+        JSON file the tuned values and the measured throughput (download MB/s, inference images/s,
+        insert rows/s) are written to after every batch with AUTOTUNE. The tuning and the measured
+        batches are restored from it at the next flow run, so the tuning also progresses if every
+        flow run processes a single batch. Without it and DAEMON, the batch size stays at BATCHSIZE,
+        by default None
+
     Returns
     -------
     None
     """
 
-    # get checkpoint from SQL before loading next
-    # Load Configurations and Init clients
-    conn = get_db_client(config_path=CONFIG_PATH)
-
-    if not USE_FS_MOUNT:
-        minio_client = get_minio_client(config_path=CONFIG_PATH)
-
     # Load configs
     with open(CONFIG_PATH, "rb") as yaml_file:
         config = yaml.load(yaml_file, yaml.FullLoader)
@@ -82,113 +597,168 @@ def etl_flow(
     with open(MODEL_CONFIG_PATH, "r") as json_file:
         model_config = json.load(json_file)
 
-    # -----------------------------------------------
-    # Extract
-    # -----------------------------------------------
-    # Extract objects to be processed
-    df_ckp = get_checkpoint(
-        conn=conn,
-        request_batch_size=BATCHSIZE,
-        model_config_id=model_config["config_id"],
-        db_schema=config['DB_SCHEMA']
-    )
-    print(f"Processing {df_ckp.shape[0]} datapoints.")
+    # Init clients, DB connections are pooled and reused by subsequent runs in this process
+    db_pool = get_db_pool(config_path=CONFIG_PATH)
 
-    # interrupt flow run if there is no new data -> state cancelled
-    if df_ckp.shape[0] == 0:
-        return Cancelled()
-
-    if USE_FS_MOUNT:
-        # transforms column object_name to show the exact name of the object 
-        # in the mounted filesystem 
-        df_ckp = build_mount_paths(
-            data=df_ckp,
-            mount_path=config["FS_MOUNT_PATH"],
-        )
-    else:
-        # downloads file from s3
-        download_files(
-            client=minio_client,
-            bucket_name=config["MINIO_BUCKET_NAME"],
-            filenames=df_ckp["object_name"].to_list(),
-            n_threads=8,
-        )
-    # -----------------------------------------------
-    # Transform and Load
-    # -----------------------------------------------
-    # Inserts model config if not exists
-    db_insert_model_config(
-        conn=conn, 
-        model_config=model_config,
-        db_schema=config['DB_SCHEMA']
-    )
+    minio_client = None
+    if not USE_FS_MOUNT:
+        minio_client = get_minio_client(config_path=CONFIG_PATH)
 
-    flower_predictions, pollinator_predictions = model_predict(
-        data=df_ckp, 
-        cfg=model_config
-    )
+    listener = None
+    if DAEMON and LISTEN:
+        with db_pool.connection() as conn:
+            ensure_notify_trigger(conn=conn, db_schema=config['DB_SCHEMA'])
+        listener = get_db_listener(config_path=CONFIG_PATH)
+    autotuner = None
+    if AUTOTUNE:
+        autotuner = BatchAutotuner(
+            batch_size=BATCHSIZE,
+            min_batch_size=MIN_BATCHSIZE,
+            max_batch_size=MAX_BATCHSIZE,
+            n_threads=DOWNLOAD_THREADS,
+            max_threads=MAX_DOWNLOAD_THREADS,
+            # fetched objects of a whole batch are held in memory
+            max_memory_mb=MAX_BUFFER_MB if IN_MEMORY and not STREAMING else None,
+            window=AUTOTUNE_WINDOW,
+            metrics_path=METRICS_PATH
+        )
 
-    # Insert image results and get back result_ids
-    result_ids = db_insert_image_results(
-        conn=conn,
-        data=df_ckp,
-        model_config=model_config,
-        allow_multiple_results=MULTI_RESULTS_FOR_IMAGE,
-        db_schema=config['DB_SCHEMA']
-    )
-    df_ckp["result_id"] = result_ids
+    # notified files which are not processed yet
+    pending_file_ids = set()
+    next_reconcile = 0
 
-    if IS_TEST:
-        df_ckp.to_csv("checkpoint_df.csv", index=False)
-        # Post-process flower predictions output
-        # write results to json if flow run is for test purpose
-        with open("flower_predictions.json", "w") as json_file:
-            json.dump(flower_predictions, json_file)
-        with open("pollinator_predictions.json", "w") as json_file:
-            json.dump(pollinator_predictions, json_file)
+    n_batches = 0
+    n_errors = 0
+    poll_seconds = POLL_MIN_SECONDS
+    idle_since = None
+    # the schema is checked once per flow run
+    ensure_schema = True
+    try:
+        while True:
+            file_ids = None
+            batch_size = BATCHSIZE if autotuner is None else autotuner.batch_size
+            if listener is not None:
+                if listener.reconnected:
+                    # notifications may be lost
+                    listener.reconnected = False
+                    next_reconcile = 0
+                pending_file_ids.update(listener.get_file_ids())
+                if len(pending_file_ids) > 0 and time.monotonic() < next_reconcile:
+                    file_ids = sorted(pending_file_ids)[:batch_size]
+                    pending_file_ids.difference_update(file_ids)
 
-    if len(flower_predictions) > 0:
-        # Flower predictions pre-processing and ingestion
-        flower_predictions = process_flower_predictions(
-            flower_predictions=flower_predictions,
-            result_ids=df_ckp,
-            model_config=model_config
-        )
-        if IS_TEST:
-            flower_predictions.to_csv('flower_predictions.csv', index=False)
+            if listener is not None and file_ids is None and time.monotonic() < next_reconcile:
+                # nothing notified and no sweep due
+                n_processed = 0
+            else:
+                try:
+                    with db_pool.connection() as conn:
+                        n_processed = run_etl_batch(
+                            db_pool=db_pool,
+                            conn=conn,
+                            minio_client=minio_client,
+                            config=config,
+                            model_config=model_config,
+                            batch_size=batch_size,
+                            n_workers=N_WORKERS,
+                            torch_threads=TORCH_THREADS,
+                            is_test=IS_TEST,
+                            multi_results_for_image=MULTI_RESULTS_FOR_IMAGE,
+                            use_fs_mount=USE_FS_MOUNT,
+                            streaming=STREAMING,
+                            stream_chunksize=STREAM_CHUNKSIZE,
+                            stream_queue_size=STREAM_QUEUE_SIZE,
+                            in_memory=IN_MEMORY,
+                            max_buffer_mb=MAX_BUFFER_MB,
+                            use_high_water_mark=USE_HIGH_WATER_MARK,
+                            high_water_mark_lag=HIGH_WATER_MARK_LAG,
+                            n_decode_workers=DECODE_WORKERS,
+                            use_claims=USE_CLAIMS,
+                            claim_lease_seconds=CLAIM_LEASE_SECONDS,
+                            ensure_schema=ensure_schema,
+                            file_ids=file_ids,
+                            download_threads=DOWNLOAD_THREADS,
+                            autotuner=autotuner
+                        )
+                except Exception as e:
+                    if not DAEMON:
+                        raise
+                    n_errors += 1
+                    print(f"Batch failed ({n_errors} in a row): {e!r}")
+                    if n_errors >= MAX_CONSECUTIVE_ERRORS:
+                        print(f"{n_errors} batches failed in a row, stopping after {n_batches} batches.")
+                        raise
+                    if file_ids is not None:
+                        # retry the notified files
+                        pending_file_ids.update(file_ids)
+                    if USE_CLAIMS:
+                        # claims which were not released expire after CLAIM_LEASE_SECONDS anyway
+                        try:
+                            with db_pool.connection() as conn:
+                                db_release_claims(
+                                    conn=conn,
+                                    model_config_id=model_config["config_id"],
+                                    worker_id=get_worker_id(),
+                                    db_schema=config['DB_SCHEMA']
+                                )
+                        except Exception as release_error:
+                            print(f"Could not release claims: {release_error!r}")
+                    print(f"Retrying in {poll_seconds} seconds.")
+                    time.sleep(poll_seconds)
+                    poll_seconds = min(poll_seconds * 2, POLL_MAX_SECONDS)
+                    continue
+                n_errors = 0
+            ensure_schema = False
 
-        flower_ids = db_insert_flower_predictions(
-            conn=conn, 
-            data=flower_predictions,
-            db_schema=config['DB_SCHEMA']
-        )
-        # Append IDs to flower predictions
-        flower_predictions = pd.concat(
-            [flower_predictions, pd.Series(flower_ids)], axis=1
-        )
-        flower_predictions = flower_predictions.rename(columns={0: "flower_id"})
-        if len(pollinator_predictions) > 0:
+            if not DAEMON:
+                # interrupt flow run if there is no new data (or none could be processed) -> state cancelled
+                if n_processed == 0:
+                    return Cancelled()
+                return
 
-            # Pollinator predictions pre-processing and ingestion
-            pollinator_predictions = process_pollinator_predictions(
-                pollinator_predictions=pollinator_predictions,
-                flower_predictions=flower_predictions,
-                model_config=model_config
-            )
-            if IS_TEST:
-                pollinator_predictions.to_csv('pollinator_predictions.csv', index=False)
+            if n_processed > 0:
+                n_batches += 1
+                poll_seconds = POLL_MIN_SECONDS
+                idle_since = None
+                if MAX_BATCHES is not None and n_batches >= MAX_BATCHES:
+                    print(f"Processed {n_batches} batches, stopping.")
+                    return
+                continue
 
-            db_insert_pollinator_predictions(
-                conn=conn, 
-                data=pollinator_predictions,
-                db_schema=config['DB_SCHEMA']
-            )
-    else:
-        print("No Flowers or Pollinators predicted")
+            if file_ids is not None:
+                # notified files were processed already (e.g. by a sweep) or could not be
+                # processed, the latter are retried by the next sweep
+                continue
+            if listener is not None and time.monotonic() >= next_reconcile:
+                # the reconciliation sweep is complete
+                next_reconcile = time.monotonic() + RECONCILE_SECONDS
 
-    # close db connection
-    conn.close()
+            # no new data, wait for notifications or poll with backoff
+            if idle_since is None:
+                idle_since = time.monotonic()
+            elif MAX_IDLE_SECONDS is not None and time.monotonic() - idle_since >= MAX_IDLE_SECONDS:
+                print(f"No new data for {MAX_IDLE_SECONDS} seconds, stopping after {n_batches} batches.")
+                return
+            if listener is not None:
+                listener.wait(min(max(next_reconcile - time.monotonic(), 0), POLL_MAX_SECONDS))
+                continue
+            print(f"No new data, polling again in {poll_seconds} seconds.")
+            time.sleep(poll_seconds)
+            poll_seconds = min(poll_seconds * 2, POLL_MAX_SECONDS)
 
+    finally:
+        if listener is not None:
+            listener.close()
 
 if __name__ == "__main__":
-    etl_flow()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Flower and pollinator ETL")
+    parser.add_argument(
+        "--daemon", action="store_true",
+        help="process batches continuously within one flow run"
+    )
+    parser.add_argument(
+        "--listen", action="store_true",
+        help="daemon mode: process new files_image rows as they are notified"
+    )
+    args = parser.parse_args()
+    etl_flow(DAEMON=args.daemon, LISTEN=args.listen)
@@ -11,6 +11,7 @@ import sys
 import yaml
 import time
 import yaml
+import threading
 
 from minio import Minio
 
@@ -179,6 +180,75 @@ class MinioBucketOperator:
 
         print(f'Extracted {len(filenames)} files in {end} seconds')
 
+    def fetch_files(self, bucket_name: str, filenames: list, n_threads: int = 8, max_bytes: int = None) -> tuple:
+        """
+        Streams all files given by path into memory buffers without touching the local filesystem.
+        Files which would exceed the memory budget are not fetched and returned as deferred. One file which
+        exceeds the whole budget on its own is fetched per call, else it would be deferred forever.
+
+        Parameters
+        ----------
+        bucket_name : str
+            name of the bucket
+
+        filenames : list
+            filenames to extract from bucket
+
+        n_threads : int, optional
+            number of threads to use for download, by default 8
+
+        max_bytes : int, optional
+            maximum number of bytes held in memory, by default None (unlimited)
+
+        Returns
+        -------
+        tuple
+            (dict object_name -> bytes, list of deferred object names)
+        """
+        buffers = {}
+        deferred = []
+        lock = threading.Lock()
+        used_bytes = [0]
+        # one file larger than max_bytes is admitted per call
+        oversize_admitted = [False]
+
+        def _fetch_file_mp(filename: str):
+            response = None
+            try:
+                response = self.client.get_object(
+                    bucket_name=bucket_name, 
+                    object_name=filename
+                )
+                size = response.headers.get('Content-Length')
+                if size is None:
+                    size = self.client.stat_object(bucket_name=bucket_name, object_name=filename).size
+                size = int(size)
+                # reserve memory budget before reading the object
+                with lock:
+                    if max_bytes is not None and size > max_bytes and not oversize_admitted[0]:
+                        oversize_admitted[0] = True
+                        print(f'{filename} ({size / 1e6:.1f} MB) exceeds the memory budget, fetched anyway')
+                    elif max_bytes is not None and used_bytes[0] + size > max_bytes:
+                        deferred.append(filename)
+                        return
+                    used_bytes[0] += size
+                buffers[filename] = response.read()
+            except Exception as e:
+                print(e, f'Not worked for {filename}')
+            finally:
+                if response is not None:
+                    response.close()
+                    response.release_conn()
+
+        start = time.perf_counter()
+        with ThreadPool(processes=n_threads) as pool:
+            pool.map(_fetch_file_mp, filenames)    
+        end = time.perf_counter() - start
+
+        print(f'Fetched {len(buffers)} files ({used_bytes[0] / 1e6:.1f} MB) in {end} seconds')
+
+        return buffers, deferred
+
     def upload_files(self, bucket_name: str, filenames: list, relative_path: str = None, n_threads: int = 8):
         """
         Uploads data to S3 with minio client.
@@ -2,6 +2,11 @@ import zmq
 import os
 import logging
 import sys
+import collections
+import json
+import queue
+import threading
+import time
 
 log = logging.getLogger(__name__)
 log.propagate = False
@@ -13,6 +18,33 @@ handler.setFormatter(
 log.addHandler(handler)
 
 
+class IdleBackoff:
+    """
+    Exponential backoff for the idle main loop: every idle round multiplies the
+    wait by factor up to max_wait, reset sets it back to min_wait.
+    """
+
+    def __init__(self, min_wait=0.1, max_wait=5, factor=2):
+        self.min_wait = min_wait
+        self.max_wait = max_wait
+        self.factor = factor
+        self.idle_rounds = 0
+        self.current = min_wait
+
+    def reset(self):
+        self.idle_rounds = 0
+        self.current = self.min_wait
+
+    def next(self):
+        """
+        Returns the time to wait in seconds for this idle round
+        """
+        wait = self.current
+        self.idle_rounds += 1
+        self.current = min(self.current * self.factor, self.max_wait)
+        return wait
+
+
 class ZMQClient:
     def __init__(self, host, port, timeout=3000, retries=20):
         self.host = host
@@ -71,6 +103,142 @@ class ZMQClient:
         self.socket.close()
         self.context.term()
 
+    def wait(self, timeout):
+        """
+        Wait for up to timeout seconds, REQ/REP can not signal new data
+        """
+        time.sleep(timeout)
+        return False
+
+
+class ZMQPrefetchClient:
+    """
+    Requests filenames from the ZMQ server ahead of time. A background thread owns
+    a DEALER socket which keeps up to `prefetch` requests in flight (the REP server
+    answers them one after another) and puts the filenames into a local queue, so
+    get_next never waits on the network.
+
+    The server removes a filename from its queue when handing it out (request
+    code 1), its protocol has no separate acknowledgement. Prefetched filenames
+    which are not processed yet are lost if the process dies, keep prefetch small.
+    """
+
+    def __init__(
+        self,
+        host,
+        port,
+        timeout=3000,
+        retries=20,
+        prefetch=4,
+        idle_interval=100,
+        max_idle_interval=5000,
+    ):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.retries = retries
+        self.prefetch = prefetch
+        self.idle_backoff = IdleBackoff(idle_interval / 1000, max_idle_interval / 1000)
+        self.context = zmq.Context().instance()
+        self.queue = queue.Queue()
+        self.data_event = threading.Event()
+        # set when get_next takes a filename, i.e. there is room for another request
+        self.space_event = threading.Event()
+        self.failed = False
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="zmq-prefetch", daemon=True)
+        self.thread.start()
+
+    def _connect(self):
+        socket = self.context.socket(zmq.DEALER)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect("tcp://{}:{}".format(self.host, self.port))
+        log.info("Connecting to tcp://{}:{}".format(self.host, self.port))
+        return socket
+
+    def _run(self):
+        socket = self._connect()
+        in_flight = 0
+        retries_left = self.retries
+        next_request_at = 0
+        while not self.stop_event.is_set():
+            # keep the prefetch window filled
+            while (
+                in_flight + self.queue.qsize() < self.prefetch
+                and time.monotonic() >= next_request_at
+            ):
+                # the empty delimiter frame makes the DEALER compatible with REP
+                socket.send_multipart([b"", json.dumps(1).encode("utf-8")])
+                in_flight += 1
+            if in_flight == 0:
+                self.space_event.clear()
+                if self.queue.qsize() >= self.prefetch:
+                    # window full, block until get_next makes room (or close)
+                    self.space_event.wait()
+                else:
+                    # backing off while the server has no data
+                    self.stop_event.wait(max(next_request_at - time.monotonic(), 0))
+                continue
+
+            if (socket.poll(self.timeout) & zmq.POLLIN) != 0:
+                reply = json.loads(socket.recv_multipart()[-1])
+                in_flight -= 1
+                retries_left = self.retries
+                if type(reply) == dict:
+                    filename = reply.get("filename")
+                    if filename is None:
+                        log.error("No filename found in message")
+                    else:
+                        self.queue.put(filename)
+                        self.data_event.set()
+                        self.idle_backoff.reset()
+                elif reply == 0:
+                    # no data available, back off before asking again
+                    next_request_at = time.monotonic() + self.idle_backoff.next()
+                else:
+                    log.info("Got message with code %d", reply)
+                continue
+
+            retries_left -= 1
+            log.warning("No response from server")
+            socket.close()
+            if retries_left == 0:
+                log.error(
+                    "ZMQ server could not be reached, abandoning\nmake sure the server is running and the port is correct"
+                )
+                self.failed = True
+                return
+            log.info("Reconnecting to server… {} retries left".format(retries_left))
+            socket = self._connect()
+            in_flight = 0
+        socket.close()
+
+    def get_next(self):
+        """
+        Get the next prefetched filename, None if there is none
+        """
+        if self.failed:
+            exit(1)
+        # clear before reading, a filename queued afterwards sets it again
+        self.data_event.clear()
+        try:
+            filename = self.queue.get_nowait()
+        except queue.Empty:
+            return None
+        self.space_event.set()
+        return filename
+
+    def wait(self, timeout):
+        """
+        Wait for up to timeout seconds, returns early when a filename arrives
+        """
+        return self.data_event.wait(timeout) or self.failed
+
+    def close(self):
+        self.stop_event.set()
+        self.space_event.set()
+        self.thread.join()
+
 
 class DirectoryInput:
     """
@@ -111,3 +279,146 @@ class DirectoryInput:
         self.index += 1
         return self.files[self.index - 1]
 
+    def wait(self, timeout):
+        """
+        Wait for up to timeout seconds, new files are found by the next scan
+        """
+        time.sleep(timeout)
+        return False
+
+
+class WatchedDirectoryInput:
+    """
+    Load images from a local directory, new files are picked up from inotify
+    events (requires inotify_simple) or, as fallback, by rescanning the directory
+    when no file is pending.
+
+    Known files are kept in an index of at most max_seen entries. The oldest
+    entries are evicted and replaced by a watermark on their inode change time
+    (ctime), rescans skip files which changed before the watermark.
+    """
+
+    def __init__(self, path, format="jpg", max_seen=100000, use_inotify=True):
+        self.path = path
+        self.format = format
+        self.max_seen = max_seen
+        self.pending = collections.deque()
+        self.seen = collections.OrderedDict()  # path -> ctime
+        self.ctime_watermark = None
+        self.inotify = None
+        self.inotify_flags = None
+        self.watches = {}
+        if use_inotify:
+            self._init_inotify()
+
+    def _init_inotify(self):
+        try:
+            from inotify_simple import INotify, flags
+        except ImportError:
+            log.warning("inotify_simple is not installed, falling back to polling")
+            return
+        self.inotify = INotify()
+        self.inotify_flags = flags
+        for dir_path, dir_names, file_names in os.walk(self.path):
+            self._add_watch(dir_path)
+
+    def _add_watch(self, dir_path):
+        flags = self.inotify_flags
+        try:
+            wd = self.inotify.add_watch(
+                dir_path, flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE
+            )
+            self.watches[wd] = dir_path
+        except OSError as e:
+            log.warning("Could not watch {}: {}".format(dir_path, e))
+
+    def _add(self, path, ctime):
+        if path in self.seen:
+            return
+        self.seen[path] = ctime
+        self.pending.append(path)
+        while len(self.seen) > self.max_seen:
+            _, evicted_ctime = self.seen.popitem(last=False)
+            if self.ctime_watermark is None or evicted_ctime > self.ctime_watermark:
+                self.ctime_watermark = evicted_ctime
+
+    def _scan_dir(self, base_path):
+        unseen_files = []
+        dirs = [base_path]
+        while len(dirs) > 0:
+            dir_path = dirs.pop()
+            try:
+                with os.scandir(dir_path) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            dirs.append(entry.path)
+                        elif entry.name.endswith(self.format) and entry.path not in self.seen:
+                            stat = entry.stat()
+                            if (
+                                self.ctime_watermark is not None
+                                and stat.st_ctime <= self.ctime_watermark
+                            ):
+                                continue
+                            unseen_files.append((stat.st_mtime, entry.path, stat.st_ctime))
+            except OSError as e:
+                log.warning("Could not scan {}: {}".format(dir_path, e))
+        unseen_files.sort()
+        for mtime, path, ctime in unseen_files:
+            self._add(path, ctime)
+        return len(unseen_files)
+
+    def scan(self):
+        """
+        Scan the directory for new images
+        """
+        log.info("scanning directory")
+        n_new = self._scan_dir(self.path)
+        log.info("adding {} new files".format(n_new))
+
+    def _read_events(self, timeout=0):
+        flags = self.inotify_flags
+        for event in self.inotify.read(timeout=timeout):
+            if event.mask & flags.Q_OVERFLOW:
+                log.warning("inotify event queue overflowed, rescanning")
+                self.scan()
+                continue
+            if event.mask & flags.IGNORED:
+                self.watches.pop(event.wd, None)
+                continue
+            dir_path = self.watches.get(event.wd)
+            if dir_path is None:
+                continue
+            path = os.path.join(dir_path, event.name)
+            if event.mask & flags.ISDIR:
+                # watch new sub directories, files might exist before the watch
+                self._add_watch(path)
+                self._scan_dir(path)
+            elif event.mask & (flags.CLOSE_WRITE | flags.MOVED_TO):
+                if path.endswith(self.format):
+                    try:
+                        self._add(path, os.stat(path).st_ctime)
+                    except OSError:
+                        pass
+
+    def get_next(self):
+        """
+        Get the next image in the directory
+        """
+        if self.inotify is not None:
+            self._read_events(timeout=0)
+        elif len(self.pending) == 0:
+            self.scan()
+        if len(self.pending) == 0:
+            return None
+        return self.pending.popleft()
+
+    def wait(self, timeout):
+        """
+        Wait for up to timeout seconds, with inotify returns early when a new
+        file arrives
+        """
+        if self.inotify is None:
+            time.sleep(timeout)
+        else:
+            self._read_events(timeout=int(timeout * 1000))
+        return len(self.pending) > 0
@@ -19,9 +19,16 @@ import yaml
 import json
 
 import argparse
-from yolomodelhelper import YoloModel
+from yolomodelhelper import YoloModel, CropCollector, DraftImage
 from messagehelper import MessageGenerator, Flower, Pollinator, MQTTClient, HTTPClient
-from inputs import ZMQClient, DirectoryInput
+from spool import ResultSpool, SpoolSender
+from inputs import (
+    ZMQClient,
+    ZMQPrefetchClient,
+    DirectoryInput,
+    WatchedDirectoryInput,
+    IdleBackoff,
+)
 import socket
 from tqdm import tqdm
 
@@ -53,12 +60,14 @@ MODEL_FLOWER_MULTI_LABEL_IOU_THRESHOLD = model_flower_config.get(
 MODEL_FLOWER_MAX_DETECTIONS = model_flower_config.get("max_detections")
 MODEL_FLOWER_AUGMENT = model_flower_config.get("augment", False)
 MODEL_FLOWER_IMG_SIZE = model_flower_config.get("image_size")
+MODEL_FLOWER_DRAFT_DECODE = model_flower_config.get("draft_decode", False)
 
 
 model_pollinator_config = cfg.get("models").get("pollinator")
 MODEL_POLLINATOR_WEIGHTS = model_pollinator_config.get("weights_path")
 MODEL_POLLINATOR_CLASS_NAMES = model_pollinator_config.get("class_names")
 MODEL_POLLINATOR_IMG_SIZE = model_pollinator_config.get("image_size")
+MODEL_POLLINATOR_BATCH_SIZE = model_pollinator_config.get("batch_size", 8)
 MODEL_POLLINATOR_CONFIDENCE_THRESHOLD = model_pollinator_config.get(
     "confidence_threshold"
 )
@@ -80,6 +89,15 @@ if INPUT_TYPE is None:
     exit(1)
 zmq_client = None
 dir_input = None
+
+# Idle strategy: exponential backoff, inputs return early when new data arrives
+idle_config = input_config.get("idle", {})
+idle_backoff = IdleBackoff(
+    min_wait=idle_config.get("min_wait", 0.1),
+    max_wait=idle_config.get("max_wait", 5),
+    factor=idle_config.get("factor", 2),
+)
+
 if INPUT_TYPE == "message_queue":
     # ZMQ Input Configuration
     zmq_config = input_config.get("message_queue")
@@ -88,7 +106,19 @@ if INPUT_TYPE == "message_queue":
     ZMQ_PORT = zmq_config.get("zmq_port")
     ZMQ_REQ_TIMEOUT = zmq_config.get("request_timeout", 3000)
     ZMQ_REQ_RETRIES = zmq_config.get("request_retries", 10)
-    zmq_client = ZMQClient(ZMQ_HOST, ZMQ_PORT, ZMQ_REQ_TIMEOUT, ZMQ_REQ_RETRIES)
+    ZMQ_PREFETCH = zmq_config.get("prefetch", 0)
+    if ZMQ_PREFETCH > 0:
+        zmq_client = ZMQPrefetchClient(
+            ZMQ_HOST,
+            ZMQ_PORT,
+            ZMQ_REQ_TIMEOUT,
+            ZMQ_REQ_RETRIES,
+            prefetch=ZMQ_PREFETCH,
+            idle_interval=int(idle_backoff.min_wait * 1000),
+            max_idle_interval=int(idle_backoff.max_wait * 1000),
+        )
+    else:
+        zmq_client = ZMQClient(ZMQ_HOST, ZMQ_PORT, ZMQ_REQ_TIMEOUT, ZMQ_REQ_RETRIES)
 else:
     # Directory Input Configuration
     directory_config = input_config.get("directory")
@@ -97,9 +127,18 @@ else:
         exit(1)
     INPUT_DIRECTORY_BASE_DIR = directory_config.get("base_dir")
     INPUT_DIRECTORY_EXTENSION = directory_config.get("extension")
-    dir_input = DirectoryInput(INPUT_DIRECTORY_BASE_DIR, INPUT_DIRECTORY_EXTENSION)
+    if directory_config.get("watch", False):
+        dir_input = WatchedDirectoryInput(
+            INPUT_DIRECTORY_BASE_DIR,
+            INPUT_DIRECTORY_EXTENSION,
+            max_seen=directory_config.get("max_seen", 100000),
+        )
+    else:
+        dir_input = DirectoryInput(INPUT_DIRECTORY_BASE_DIR, INPUT_DIRECTORY_EXTENSION)
     dir_input.scan()
 
+input_source = zmq_client if INPUT_TYPE == "message_queue" else dir_input
+
 REMOVE_FILES_AFTER_PROCESSING = input_config.get("remove_after_processing", False)
 if REMOVE_FILES_AFTER_PROCESSING:
     log.warning("Removing files after processing")
@@ -111,6 +150,7 @@ IGNORE_EMPTY_RESULTS = output_config.get("ignore_empty_results", False)
 STORE_FILE = False
 BASE_DIR = "output"
 SAVE_CROPS = True
+CROP_JPEG_QUALITY = output_config.get("crop_jpeg_quality", 75)
 if output_config.get("file") is not None:
     output_config_file = output_config.get("file")
     if output_config_file.get("store_file", False):
@@ -141,11 +181,19 @@ if output_config.get("mqtt") is not None:
             )
         )
         mclient = MQTTClient(
-            mqtt_host, mqtt_port, mqtt_topic, mqtt_username, mqtt_password, mqtt_use_tls
+            mqtt_host,
+            mqtt_port,
+            mqtt_topic,
+            mqtt_username,
+            mqtt_password,
+            mqtt_use_tls,
+            max_inflight=output_config_mqtt.get("max_inflight", 20),
+            max_queued=output_config_mqtt.get("max_queued", 1000),
         )
 
 # Output configuration (HTTP)
 TRANSMIT_HTTP = False
+HTTP_STREAM = False
 hclient = None
 if output_config.get("http") is not None:
     output_config_http = output_config.get("http")
@@ -157,16 +205,57 @@ if output_config.get("http") is not None:
         http_username = output_config_http.get("username")
         http_password = output_config_http.get("password")
         http_method = output_config_http.get("method", "POST")
+        http_batch_size = output_config_http.get("batch_size", 1)
+        http_pool_maxsize = output_config_http.get("pool_maxsize", 4)
+        http_timeout = output_config_http.get("timeout")
+        http_max_buffered = output_config_http.get("max_buffered", 1000)
+        HTTP_STREAM = output_config_http.get("stream", False)
         log.info(
-            "HTTP url: {}, method: {}, username: {}".format(
-                http_url, http_method, http_username
+            "HTTP url: {}, method: {}, username: {}, batch_size: {}".format(
+                http_url, http_method, http_username, http_batch_size
             )
         )
-        hclient = HTTPClient(http_url, http_username, http_password, http_method)
+        hclient = HTTPClient(
+            http_url,
+            http_username,
+            http_password,
+            http_method,
+            batch_size=http_batch_size,
+            pool_maxsize=http_pool_maxsize,
+            timeout=http_timeout,
+            max_buffered=http_max_buffered,
+        )
+
+
+# Output configuration (spool)
+# results are written to a local database and sent by a background thread
+spool_config = output_config.get("spool") or {}
+SPOOL = spool_config.get("enabled", False) and (TRANSMIT_HTTP or TRANSMIT_MQTT)
+if SPOOL:
+    spool_senders = {}
+    if TRANSMIT_HTTP:
+        spool_senders["http"] = lambda rows: hclient.send_batch(rows, hostname=HOSTNAME)
+    if TRANSMIT_MQTT:
+        spool_senders["mqtt"] = lambda rows: mclient.publish_batch(rows, hostname=HOSTNAME)
+    result_spool = ResultSpool(spool_config.get("path", "spool.sqlite"))
+    spool_sender = SpoolSender(
+        result_spool,
+        spool_senders,
+        batch_size=spool_config.get("batch_size", 20),
+        max_backoff=spool_config.get("max_backoff", 300),
+    )
+    spool_sender.start()
+    log.info(
+        "Spooling results to {}, {} results pending".format(
+            spool_config.get("path", "spool.sqlite"), result_spool.count()
+        )
+    )
 
 
 def get_filename():
-    if INPUT_TYPE == "message_queue":
+    if INPUT_TYPE == "message_queue" and ZMQ_PREFETCH > 0:
+        return zmq_client.get_next()
+    elif INPUT_TYPE == "message_queue":
         msg = zmq_client.request_message(1)
         if type(msg) == dict:
             filename = msg.get("filename")
@@ -210,106 +299,146 @@ pollinator_model = YoloModel(
     multi_label_iou_threshold=MODEL_POLLINATOR_MULTI_LABEL_IOU_THRESHOLD,
     augment=MODEL_POLLINATOR_AUGMENT,
     max_det=MODEL_POLLINATOR_MAX_DETECTIONS,
+    batch_size=MODEL_POLLINATOR_BATCH_SIZE,
 )
 
-while True:
-    filename = get_filename()
-    if filename is not None:
-        generator = MessageGenerator()
-        log.info("Processing image: %s", os.path.basename(filename))
-        generator.set_filename(os.path.basename(filename))
-
-        flower_model.reset_inference_times()
-        pollinator_model.reset_inference_times()
-        pollinator_index = 0
-        # predict flower
-        try:
-            img = Image.open(filename)
-            original_width, original_height = img.size
-            flower_model.predict(img)
-        except Exception as e:
-            log.error("Error predicting flowers on file %s: %s", filename, e)
-            continue
-        flower_crops = flower_model.get_crops()
-        flower_boxes = flower_model.get_boxes()
-        flower_classes = flower_model.get_classes()
-        flower_scores = flower_model.get_scores()
-        flower_names = flower_model.get_names()
-        for flower_index in tqdm(range(len(flower_crops))):
-            # add flower to message
-            # TODO: add flower to message
-            width, height = (
-                flower_crops[flower_index].shape[1],
-                flower_crops[flower_index].shape[0],
-            )
-            flower_obj = Flower(
-                index=flower_index,
-                class_name=flower_names[flower_index],
-                score=flower_scores[flower_index],
-                width=width,
-                height=height,
-            )
-            generator.add_flower(flower_obj)
-            # predict pollinator
-            pollinator_model.predict(flower_crops[flower_index])
-            pollinator_boxes = pollinator_model.get_boxes()
-            pollinator_crops = pollinator_model.get_crops()
-            pollinator_classes = pollinator_model.get_classes()
-            pollinator_scores = pollinator_model.get_scores()
-            pollinator_names = pollinator_model.get_names()
-            pollinator_indexes = pollinator_model.get_indexes()
-            for detected_pollinator in range(len(pollinator_crops)):
-                idx = pollinator_index + pollinator_indexes[detected_pollinator]
-                crop_image = Image.fromarray(pollinator_crops[detected_pollinator])
-                width_polli, height_polli = crop_image.size
-                # add pollinator to message
-                pollinator_obj = Pollinator(
-                    index=idx,
-                    flower_index=flower_index,
-                    class_name=pollinator_names[detected_pollinator],
-                    score=pollinator_scores[detected_pollinator],
-                    width=width_polli,
-                    height=height_polli,
-                    crop=crop_image,
-                )
-                generator.add_pollinator(pollinator_obj)
-            if len(pollinator_indexes) > 0:
-                pollinator_index += max(pollinator_indexes) + 1
-        log.info("Found {} flowers in {} ms".format(len(flower_crops), int(flower_model.get_inference_times()[0]*1000)))
-        log.info("Found {} pollinators in {} ms".format(pollinator_index, int(pollinator_model.get_inference_times()[0]*1000)))
-        # add metadata to message
-        generator.add_metadata(flower_model.get_metadata(), "flower_inference")
-        generator.add_metadata(pollinator_model.get_metadata(), "pollinator_inference")
-        generator.add_metadata(
-            {"size": [original_width, original_height]}, "original_image"
-        )
+try:
+    while True:
+        filename = get_filename()
+        if filename is not None:
+            idle_backoff.reset()
+            generator = MessageGenerator()
+            log.info("Processing image: %s", os.path.basename(filename))
+            generator.set_filename(os.path.basename(filename))
 
-        result = generator.generate_message()
-        if IGNORE_EMPTY_RESULTS and len(generator.pollinators) == 0:
-            log.info("No pollinators detected, skipping")
-            continue
-        if STORE_FILE:
-            generator.store_message(BASE_DIR, SAVE_CROPS)
-        if TRANSMIT_HTTP:
-            hclient.send_message(
-                result,
-                filename=generator.generate_filename(),
-                node_id=generator.node_id,
-                hostname=HOSTNAME,
-            )
-        if TRANSMIT_MQTT:
-            mclient.publish(
-                result,
-                filename=generator.generate_filename(),
-                node_id=generator.node_id,
-                hostname=HOSTNAME,
+            flower_model.reset_inference_times()
+            pollinator_model.reset_inference_times()
+            pollinator_index = 0
+            # predict flower
+            try:
+                if MODEL_FLOWER_DRAFT_DECODE:
+                    img = DraftImage(filename, MODEL_FLOWER_IMG_SIZE)
+                    original_width, original_height = img.full_size
+                else:
+                    img = Image.open(filename)
+                    original_width, original_height = img.size
+                flower_model.predict(img)
+            except Exception as e:
+                log.error("Error predicting flowers on file %s: %s", filename, e)
+                continue
+            flower_crops = flower_model.get_crops()
+            if MODEL_FLOWER_DRAFT_DECODE:
+                img.release()
+            flower_boxes = flower_model.get_boxes()
+            flower_classes = flower_model.get_classes()
+            flower_scores = flower_model.get_scores()
+            flower_names = flower_model.get_names()
+            crop_collector = CropCollector()
+            for flower_index in range(len(flower_crops)):
+                # add flower to message
+                width, height = (
+                    flower_crops[flower_index].shape[1],
+                    flower_crops[flower_index].shape[0],
+                )
+                flower_obj = Flower(
+                    index=flower_index,
+                    class_name=flower_names[flower_index],
+                    score=flower_scores[flower_index],
+                    width=width,
+                    height=height,
+                )
+                generator.add_flower(flower_obj)
+                crop_collector.add(flower_index, flower_crops[flower_index])
+            # predict pollinators on all flower crops at once
+            crop_indexes = crop_collector.predict(pollinator_model)
+            for flower_index, crop_index in tqdm(crop_indexes.items()):
+                pollinator_boxes = pollinator_model.get_boxes(crop_index)
+                pollinator_crops = pollinator_model.get_crops(crop_index)
+                pollinator_classes = pollinator_model.get_classes(crop_index)
+                pollinator_scores = pollinator_model.get_scores(crop_index)
+                pollinator_names = pollinator_model.get_names(crop_index)
+                pollinator_indexes = pollinator_model.get_indexes(crop_index)
+                for detected_pollinator in range(len(pollinator_crops)):
+                    idx = pollinator_index + pollinator_indexes[detected_pollinator]
+                    crop_image = Image.fromarray(pollinator_crops[detected_pollinator])
+                    width_polli, height_polli = crop_image.size
+                    # add pollinator to message
+                    pollinator_obj = Pollinator(
+                        index=idx,
+                        flower_index=flower_index,
+                        class_name=pollinator_names[detected_pollinator],
+                        score=float(pollinator_scores[detected_pollinator]),
+                        width=width_polli,
+                        height=height_polli,
+                        crop=crop_image,
+                        jpeg_quality=CROP_JPEG_QUALITY,
+                    )
+                    generator.add_pollinator(pollinator_obj)
+                if len(pollinator_indexes) > 0:
+                    pollinator_index += max(pollinator_indexes) + 1
+            log.info("Found {} flowers in {} ms".format(len(flower_crops), int(flower_model.get_inference_times()[0]*1000)))
+            log.info("Found {} pollinators in {} ms".format(pollinator_index, int(pollinator_model.get_inference_times()[0]*1000)))
+            # add metadata to message
+            generator.add_metadata(flower_model.get_metadata(), "flower_inference")
+            generator.add_metadata(pollinator_model.get_metadata(), "pollinator_inference")
+            generator.add_metadata(
+                {"size": [original_width, original_height]}, "original_image"
             )
 
-        # print(json.dumps(result))
-        if REMOVE_FILES_AFTER_PROCESSING:
-            log.info("Removing file %s", filename)
-            os.remove(filename)
+            if IGNORE_EMPTY_RESULTS and len(generator.pollinators) == 0:
+                log.info("No pollinators detected, skipping")
+                continue
+            # crops are encoded once and shared by all outputs
+            if STORE_FILE:
+                generator.store_message(BASE_DIR, SAVE_CROPS)
+            if SPOOL:
+                payload = generator.dumps_message()
+                for target in spool_senders:
+                    result_spool.put(
+                        target,
+                        payload,
+                        filename=generator.generate_filename(),
+                        node_id=generator.node_id,
+                    )
+            elif TRANSMIT_HTTP and HTTP_STREAM and hclient.batch_size == 1:
+                hclient.send_stream(
+                    generator.iter_message(),
+                    filename=generator.generate_filename(),
+                    node_id=generator.node_id,
+                    hostname=HOSTNAME,
+                )
+            elif TRANSMIT_HTTP:
+                hclient.send_message(
+                    generator.generate_message(),
+                    filename=generator.generate_filename(),
+                    node_id=generator.node_id,
+                    hostname=HOSTNAME,
+                )
+            if TRANSMIT_MQTT and not SPOOL:
+                mclient.publish(
+                    generator.dumps_message(),
+                    filename=generator.generate_filename(),
+                    node_id=generator.node_id,
+                    hostname=HOSTNAME,
+                )
+
+            # print(json.dumps(result))
+            if REMOVE_FILES_AFTER_PROCESSING:
+                log.info("Removing file %s", filename)
+                os.remove(filename)
 
-    else:
-        log.info("No data available")
-        time.sleep(5)
+        else:
+            if idle_backoff.idle_rounds == 0:
+                log.info("No data available")
+                if TRANSMIT_HTTP and not SPOOL:
+                    # send partially filled batches while idle
+                    hclient.flush()
+            input_source.wait(idle_backoff.next())
+finally:
+    # send what is buffered before exiting (end of input or Ctrl-C)
+    if SPOOL:
+        spool_sender.stop(timeout=30)
+    elif TRANSMIT_HTTP:
+        hclient.close()
+    if TRANSMIT_MQTT:
+        mclient.close()
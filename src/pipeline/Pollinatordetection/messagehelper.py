@@ -3,13 +3,15 @@ import datetime
 from PIL import Image
 from io import BytesIO
 import base64
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 import os
 import sys
+import time
 
 import logging
 import ssl
 import requests
+from requests.adapters import HTTPAdapter
 
 log = logging.getLogger(__name__)
 log.propagate = False
@@ -21,6 +23,7 @@ handler.setFormatter(
 log.addHandler(handler)
 
 DECIMALS_TO_ROUND = 3
+JPEG_QUALITY = 75
 
 
 @dataclass
@@ -49,6 +52,16 @@ class Pollinator:
     width: int
     height: int
     crop: Image
+    jpeg_quality: int = JPEG_QUALITY
+    # base64 encoded JPEG of the crop, encoded at the first use
+    _encoded_crop: str = field(default=None, repr=False, compare=False)
+
+    def get_encoded_crop(self):
+        if self._encoded_crop is None:
+            bio = BytesIO()
+            self.crop.save(bio, format="JPEG", quality=self.jpeg_quality)
+            self._encoded_crop = base64.b64encode(bio.getvalue()).decode("utf-8")
+        return self._encoded_crop
 
     def to_dict(self, save_crop=True):
 
@@ -60,13 +73,23 @@ class Pollinator:
             "crop": None,
         }
         if save_crop:
-            bio = BytesIO()
-            self.crop.save(bio, format="JPEG")
-            bio.seek(0)
-            encoded_image = base64.b64encode(bio.read()).decode("utf-8")
-            pollintor_dict["crop"] = encoded_image
+            pollintor_dict["crop"] = self.get_encoded_crop()
         return pollintor_dict
 
+    def iter_json(self, save_crop=True):
+        """
+        Yields the JSON of to_dict in chunks, the crop is not copied into a dict
+        """
+        pollinator_dict = self.to_dict(save_crop=False)
+        del pollinator_dict["crop"]
+        yield json.dumps(pollinator_dict)[:-1]
+        if save_crop:
+            yield ', "crop": "'
+            yield self.get_encoded_crop()
+            yield '"}'
+        else:
+            yield ', "crop": null}'
+
 
 class MessageGenerator:
     def __init__(self):
@@ -109,7 +132,7 @@ class MessageGenerator:
         for flower in self.flowers:
             flowers.append(flower.to_dict())
         for pollinator in self.pollinators:
-            pollinators.append(pollinator.to_dict())
+            pollinators.append(pollinator.to_dict(save_crop))
         flowers.sort(key=lambda x: x["index"])
         pollinators.sort(key=lambda x: x["index"])
 
@@ -119,6 +142,37 @@ class MessageGenerator:
         }
         return message
 
+    def iter_message(self, save_crop=True):
+        """
+        Yields the JSON of generate_message in chunks without building the message,
+        the crops are written as they are encoded.
+        """
+        flowers = sorted(self.flowers, key=lambda x: x.index)
+        pollinators = sorted(self.pollinators, key=lambda x: x.index)
+        yield '{"detections": {"flowers": '
+        yield json.dumps([flower.to_dict() for flower in flowers])
+        yield ', "pollinators": ['
+        for i, pollinator in enumerate(pollinators):
+            if i > 0:
+                yield ", "
+            yield from pollinator.iter_json(save_crop)
+        yield ']}, "metadata": '
+        yield json.dumps(self.metadata)
+        yield "}"
+
+    def write_message(self, stream, save_crop=True):
+        """
+        Writes the JSON message to a text stream chunk by chunk
+        """
+        for chunk in self.iter_message(save_crop):
+            stream.write(chunk)
+
+    def dumps_message(self, save_crop=True):
+        """
+        Returns the JSON message as string, equal to json.dumps(generate_message())
+        """
+        return "".join(self.iter_message(save_crop))
+
     def generate_filename(self, format=".json"):
         filename = (
             self.node_id + "_" + self.timestamp.strftime("%Y-%m-%dT%H-%M-%SZ") + format
@@ -156,19 +210,40 @@ class MessageGenerator:
             os.makedirs(filepath)
             log.info("Created directory: {}".format(filepath))
         with open(filepath + self.generate_filename(), "w") as f:
-            json.dump(self.generate_message(save_crop=save_crop), f)
+            self.write_message(f, save_crop=save_crop)
         log.info("Saved message to: {}".format(filepath + self.generate_filename()))
         return True
 
 
 class MQTTClient:
-    def __init__(self, host, port, topic, username, password, use_tls):
+    """
+    Publishes results over a long-lived MQTT connection. The network loop runs in
+    a background thread, publish only enqueues the message: up to max_inflight
+    QoS 1 messages wait for their acknowledgement at a time, up to max_queued
+    messages are buffered (also while disconnected) before new ones are dropped.
+    """
+
+    def __init__(
+        self,
+        host,
+        port,
+        topic,
+        username,
+        password,
+        use_tls,
+        max_inflight=20,
+        max_queued=1000,
+        keepalive=60,
+    ):
         self.host = host
         self.port = port
         self.topic = topic
         self.username = username
         self.password = password
         self.use_tls = use_tls
+        self.max_inflight = max_inflight
+        self.max_queued = max_queued
+        self.keepalive = keepalive
         if self.username is not None and self.password is not None:
             self.auth = {
                 "username": self.username,
@@ -176,10 +251,43 @@ class MQTTClient:
             }
         else:
             self.auth = None
+        self.mqtt = None
+        self.client = None
 
-    def publish(self, message, filename=None, node_id=None, hostname=None):
-        import paho.mqtt.publish as publish
+    def _connect(self):
+        import paho.mqtt.client as mqtt
+
+        try:
+            # paho-mqtt >= 2.0
+            client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1)
+        except AttributeError:
+            client = mqtt.Client()
+        if self.auth is not None:
+            client.username_pw_set(self.username, self.password)
+        if self.use_tls:
+            client.tls_set(cert_reqs=ssl.CERT_REQUIRED, tls_version=ssl.PROTOCOL_TLSv1_2)
+        client.max_inflight_messages_set(self.max_inflight)
+        client.max_queued_messages_set(self.max_queued)
+        client.reconnect_delay_set(min_delay=1, max_delay=60)
+        client.on_connect = self._on_connect
+        client.on_disconnect = self._on_disconnect
+        log.info("Connecting to MQTT broker {}:{}".format(self.host, self.port))
+        client.connect_async(self.host, self.port, self.keepalive)
+        client.loop_start()
+        self.mqtt = mqtt
+        self.client = client
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            log.info("Connected to MQTT broker {}".format(self.host))
+        else:
+            log.error("MQTT connection refused, return code {}".format(rc))
+
+    def _on_disconnect(self, client, userdata, rc):
+        if rc != 0:
+            log.warning("Lost connection to MQTT broker, reconnecting")
 
+    def publish(self, message, filename=None, node_id=None, hostname=None):
         topic = self.topic
         if filename is not None:
             topic = topic.replace("${filename}", filename)
@@ -187,41 +295,109 @@ class MQTTClient:
             topic = topic.replace("${node_id}", node_id)
         if hostname is not None:
             topic = topic.replace("${hostname}", hostname)
+        if self.client is None:
+            self._connect()
         log.info("Publishing to {} on topic: {}".format(self.host, topic))
-        tls_config = None
-        if self.use_tls:
-            tls_config = {
-                "certfile": None,
-                "keyfile": None,
-                "cert_reqs": ssl.CERT_REQUIRED,
-                "tls_version": ssl.PROTOCOL_TLSv1_2,
-                "ciphers": None,
-            }
+        if not isinstance(message, (str, bytes)):
+            message = json.dumps(message)
+        info = self.client.publish(topic, message, qos=1)
+        if info.rc == self.mqtt.MQTT_ERR_QUEUE_SIZE:
+            log.error("MQTT outbound queue is full, message dropped")
+            return False
+        if info.rc == self.mqtt.MQTT_ERR_NO_CONN:
+            log.warning("Not connected to MQTT broker, message queued")
+        return True
 
-        publish.single(
-            topic,
-            json.dumps(message),
-            1,
-            auth=self.auth,
-            hostname=self.host,
-            port=self.port,
-            tls=tls_config,
+    def publish_batch(self, rows, hostname=None, timeout=30):
+        """
+        Publishes serialized messages given as (filename, node_id, payload) and
+        waits for their acknowledgement. Returns a list with True for every
+        acknowledged message. Nothing is queued (and None returned for every
+        message, not tried) while disconnected.
+        """
+        if self.client is None:
+            self._connect()
+        if not self.client.is_connected():
+            return [None] * len(rows)
+        infos = []
+        for filename, node_id, payload in rows:
+            topic = self.topic
+            if filename is not None:
+                topic = topic.replace("${filename}", filename)
+            if node_id is not None:
+                topic = topic.replace("${node_id}", node_id)
+            if hostname is not None:
+                topic = topic.replace("${hostname}", hostname)
+            infos.append(self.client.publish(topic, payload, qos=1))
+        delivered = []
+        deadline = time.monotonic() + timeout
+        for info in infos:
+            try:
+                info.wait_for_publish(max(deadline - time.monotonic(), 0))
+                delivered.append(info.is_published())
+            except (RuntimeError, ValueError):
+                delivered.append(False)
+        log.info(
+            "Published {} of {} spooled results to {}".format(
+                sum(delivered), len(rows), self.host
+            )
         )
+        return delivered
+
+    def close(self):
+        if self.client is not None:
+            self.client.loop_stop()
+            self.client.disconnect()
+            self.client = None
 
 
 class HTTPClient:
-    def __init__(self, url, username, password, method="POST"):
+    """
+    Sends results over a persistent HTTP session (keep-alive, pooled connections).
+    With batch_size > 1 messages are buffered per URL and sent as JSON array
+    once batch_size messages are collected or flush is called. Messages of a
+    failed request stay buffered and are sent with the next request, up to
+    max_buffered messages per URL (the oldest are dropped).
+    """
+
+    def __init__(
+        self,
+        url,
+        username,
+        password,
+        method="POST",
+        batch_size=1,
+        pool_maxsize=4,
+        timeout=None,
+        max_buffered=1000,
+    ):
         self.url = url
         self.username = username
         self.password = password
         self.method = method
+        self.timeout = timeout
         if self.username is not None and self.password is not None:
             self.auth = (self.username, self.password)
         else:
             self.auth = None
+        if batch_size > 1 and "${filename}" in self.url:
+            log.warning("URL depends on the filename, batching is disabled")
+            batch_size = 1
+        self.batch_size = batch_size
+        self.max_buffered = max_buffered
+        self.buffers = {}
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers["Content-type"] = "application/json"
+        if self.auth is not None:
+            self.session.headers["Authorization"] = "Basic " + base64.b64encode(
+                bytes(self.auth[0] + ":" + self.auth[1], "utf-8")
+            ).decode("utf-8")
 
-    def send_message(self, message, filename=None, node_id=None, hostname=None):
-        headers = {"Content-type": "application/json"}
+    def _format_url(self, filename=None, node_id=None, hostname=None):
         url = self.url
         if filename is not None:
             url = url.replace("${filename}", filename)
@@ -229,15 +405,12 @@ class HTTPClient:
             url = url.replace("${node_id}", node_id)
         if hostname is not None:
             url = url.replace("${hostname}", hostname)
-        log.info("Sending results to {}".format(url))
+        return url
 
-        if self.auth is not None:
-            headers["Authorization"] = "Basic " + base64.b64encode(
-                bytes(self.auth[0] + ":" + self.auth[1], "utf-8")
-            ).decode("utf-8")
+    def _send(self, url, data):
         try:
-            response = requests.request(
-                self.method, url, headers=headers, data=json.dumps(message)
+            response = self.session.request(
+                self.method, url, data=data, timeout=self.timeout
             )
             if response.status_code == 200:
                 log.info("Successfully sent results to {}".format(url))
@@ -252,3 +425,83 @@ class HTTPClient:
         except Exception as e:
             log.error(e)
             return False
+
+    def send_message(self, message, filename=None, node_id=None, hostname=None):
+        url = self._format_url(filename, node_id, hostname)
+        if self.batch_size > 1:
+            buffer = self.buffers.setdefault(url, [])
+            buffer.append(message)
+            if len(buffer) >= self.batch_size:
+                return self._flush_url(url)
+            return True
+        log.info("Sending results to {}".format(url))
+        return self._send(url, json.dumps(message))
+
+    def send_stream(self, chunks, filename=None, node_id=None, hostname=None):
+        """
+        Sends one message given as iterable of JSON string chunks (see
+        MessageGenerator.iter_message) with chunked transfer encoding
+        """
+        url = self._format_url(filename, node_id, hostname)
+        log.info("Streaming results to {}".format(url))
+        return self._send(url, (chunk.encode("utf-8") for chunk in chunks))
+
+    def send_batch(self, rows, hostname=None):
+        """
+        Sends serialized messages given as (filename, node_id, payload). With
+        batch_size > 1 the messages of one URL are sent as JSON array. Returns a
+        list with True for every delivered and False for every failed message,
+        stops at the first failure: the remaining messages are None (not tried).
+        """
+        delivered = [None] * len(rows)
+        urls = {}
+        for i, (filename, node_id, _) in enumerate(rows):
+            urls.setdefault(self._format_url(filename, node_id, hostname), []).append(i)
+        for url, indexes in urls.items():
+            if self.batch_size > 1:
+                groups = [indexes]
+            else:
+                groups = [[i] for i in indexes]
+            for group in groups:
+                if self.batch_size > 1:
+                    data = "[" + ", ".join(rows[i][2] for i in group) + "]"
+                else:
+                    data = rows[group[0]][2]
+                success = self._send(url, data)
+                for i in group:
+                    delivered[i] = success
+                if not success:
+                    return delivered
+        return delivered
+
+    def _flush_url(self, url):
+        messages = self.buffers.pop(url, [])
+        if len(messages) == 0:
+            return True
+        log.info("Sending {} results to {}".format(len(messages), url))
+        if self._send(url, json.dumps(messages)):
+            return True
+        # keep the messages for the next request
+        messages = messages + self.buffers.get(url, [])
+        if len(messages) > self.max_buffered:
+            log.warning(
+                "Dropping {} buffered results for {}".format(
+                    len(messages) - self.max_buffered, url
+                )
+            )
+            messages = messages[-self.max_buffered:]
+        self.buffers[url] = messages
+        return False
+
+    def flush(self):
+        """
+        Sends all buffered messages. Returns False if any request failed.
+        """
+        success = True
+        for url in list(self.buffers.keys()):
+            success = self._flush_url(url) and success
+        return success
+
+    def close(self):
+        self.flush()
+        self.session.close()
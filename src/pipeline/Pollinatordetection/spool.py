@@ -0,0 +1,231 @@
+import sqlite3
+import logging
+import sys
+import threading
+import time
+
+log = logging.getLogger(__name__)
+log.propagate = False
+log.setLevel(logging.INFO)
+handler = logging.StreamHandler(stream=sys.stdout)
+handler.setFormatter(
+    logging.Formatter("%(asctime)s %(name)s %(levelname)s %(message)s")
+)
+log.addHandler(handler)
+
+
+class ResultSpool:
+    """
+    Durable local queue of serialized results in a SQLite database (WAL mode).
+    put returns as soon as the result is on disk, a SpoolSender delivers the
+    results to their target (e.g. "http" or "mqtt") and deletes them once sent.
+    Every thread uses its own connection.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.new_data = threading.Event()
+        conn = self._conn()
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            # spool created without incremental auto vacuum, only VACUUM changes it
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS results (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                target TEXT NOT NULL,
+                filename TEXT,
+                node_id TEXT,
+                payload TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL
+            )
+            """
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS results_target_next_attempt_idx "
+            "ON results (target, next_attempt_at)"
+        )
+        conn.commit()
+
+    def _conn(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            # has to be set before WAL, else a new database keeps auto_vacuum NONE
+            # and compact cannot release the pages of delivered results
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def put(self, target, payload, filename=None, node_id=None):
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                "INSERT INTO results (target, filename, node_id, payload, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (target, filename, node_id, payload, time.time()),
+            )
+        self.new_data.set()
+
+    def get_due(self, target, limit):
+        """
+        Returns up to limit results of target which are due for (re)delivery,
+        oldest first, as tuples (id, filename, node_id, payload, attempts)
+        """
+        return (
+            self._conn()
+            .execute(
+                "SELECT id, filename, node_id, payload, attempts FROM results "
+                "WHERE target = ? AND next_attempt_at <= ? ORDER BY id LIMIT ?",
+                (target, time.time(), limit),
+            )
+            .fetchall()
+        )
+
+    def ack(self, ids):
+        """
+        Removes delivered results
+        """
+        conn = self._conn()
+        with conn:
+            conn.executemany("DELETE FROM results WHERE id = ?", [(i,) for i in ids])
+
+    def retry(self, ids, delay):
+        """
+        Schedules failed results for another attempt after delay seconds
+        """
+        conn = self._conn()
+        with conn:
+            conn.executemany(
+                "UPDATE results SET attempts = attempts + 1, next_attempt_at = ? "
+                "WHERE id = ?",
+                [(time.time() + delay, i) for i in ids],
+            )
+
+    def count(self, target=None):
+        if target is None:
+            row = self._conn().execute("SELECT count(*) FROM results").fetchone()
+        else:
+            row = (
+                self._conn()
+                .execute("SELECT count(*) FROM results WHERE target = ?", (target,))
+                .fetchone()
+            )
+        return row[0]
+
+    def compact(self):
+        """
+        Releases the pages of delivered results and truncates the WAL
+        """
+        conn = self._conn()
+        # executescript runs the pragma to completion, execute frees only one page
+        conn.executescript("PRAGMA incremental_vacuum")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        conn.commit()
+
+    def close(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+
+class SpoolSender:
+    """
+    Background thread which drains a ResultSpool. senders maps a target to a
+    function which gets a list of (filename, node_id, payload) tuples and
+    returns a list with True for every delivered result, False for every
+    failed one and None for results which were not tried. Results are sent in
+    batches of batch_size. Failed results are retried with exponential backoff
+    from min_backoff to max_backoff seconds. A failed batch also pauses its
+    target with the same backoff, so an unreachable server is not hammered
+    while new results keep arriving.
+    """
+
+    def __init__(
+        self,
+        spool,
+        senders,
+        batch_size=20,
+        min_backoff=1,
+        max_backoff=300,
+        poll_interval=5,
+        compact_interval=600,
+    ):
+        self.spool = spool
+        self.senders = senders
+        self.batch_size = batch_size
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.poll_interval = poll_interval
+        self.compact_interval = compact_interval
+        # target -> (consecutive failed batches, paused until)
+        self.target_backoff = {}
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="spool-sender", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def _backoff(self, attempts):
+        return min(self.min_backoff * 2**attempts, self.max_backoff)
+
+    def _drain(self, target, send):
+        """
+        Sends the due results of target until none are left or a batch fails
+        """
+        failures, paused_until = self.target_backoff.get(target, (0, 0))
+        if time.monotonic() < paused_until:
+            return
+        while not self.stop_event.is_set():
+            rows = self.spool.get_due(target, self.batch_size)
+            if len(rows) == 0:
+                return
+            try:
+                delivered = send([(row[1], row[2], row[3]) for row in rows])
+            except Exception as e:
+                log.error("Sending spooled results to %s failed: %s", target, e)
+                delivered = [False] * len(rows)
+            self.spool.ack([row[0] for row, ok in zip(rows, delivered) if ok])
+            # results which were not tried keep their attempts
+            for row, ok in zip(rows, delivered):
+                if ok is False:
+                    self.spool.retry([row[0]], self._backoff(row[4]))
+            failed = [row for row, ok in zip(rows, delivered) if not ok]
+            if len(failed) > 0:
+                self.target_backoff[target] = (
+                    failures + 1,
+                    time.monotonic() + self._backoff(failures),
+                )
+                log.warning(
+                    "%d results for %s could not be sent, %d spooled",
+                    len(failed),
+                    target,
+                    self.spool.count(target),
+                )
+                return
+            self.target_backoff.pop(target, None)
+
+    def _run(self):
+        last_compact = time.monotonic()
+        while not self.stop_event.is_set():
+            self.spool.new_data.clear()
+            for target, send in self.senders.items():
+                self._drain(target, send)
+            if time.monotonic() - last_compact > self.compact_interval:
+                self.spool.compact()
+                last_compact = time.monotonic()
+            # new results wake up the sender, retries are picked up by polling
+            self.spool.new_data.wait(self.poll_interval)
+        self.spool.close()
+
+    def stop(self, timeout=None):
+        self.stop_event.set()
+        self.spool.new_data.set()
+        self.thread.join(timeout)
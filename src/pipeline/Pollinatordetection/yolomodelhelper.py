@@ -1,9 +1,97 @@
 import torch
 import time
 import os
+import math
+from io import BytesIO
 import numpy as np
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw, ImageFont, ImageOps
 import logging
+import json
+import hashlib
+import threading
+from dataclasses import dataclass
+
+# process-level registry of loaded models, see load_model
+_MODEL_REGISTRY = {}
+_MODEL_REGISTRY_LOCK = threading.Lock()
+
+
+@dataclass
+class ImageDetections:
+    """
+    Detections of one image, decoded once from the yolov5 results.
+    """
+
+    boxes: np.ndarray  # (n, 4) float32, [xmin, ymin, xmax, ymax]
+    scores: np.ndarray  # (n,) float32
+    classes: np.ndarray  # (n,) int64
+    names: np.ndarray  # (n,) object
+    image: np.ndarray  # (height, width, 3) image the model ran on
+    source: "DraftImage" = None  # set if the model ran on a reduced resolution
+
+    def __len__(self):
+        return len(self.boxes)
+
+
+# EXIF orientations which swap width and height
+_TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+
+
+class DraftImage:
+    """
+    Image decoded at reduced resolution for inference. JPEGs are decoded with
+    PIL's draft mode (DCT scaling by 1/2, 1/4 or 1/8) at the smallest scale
+    whose longest side is still at least min_size, other formats are decoded at
+    full resolution. The full resolution is decoded on demand (get_full), e.g.
+    for crops. source is a path or the encoded bytes of the image.
+    """
+
+    def __init__(self, source, min_size):
+        self.source = source
+        self._full = None
+        img = self._open()
+        width, height = img.size
+        orientation = img.getexif().get(0x0112, 1)
+        scale = min_size / max(width, height)
+        if scale < 1:
+            img.draft("RGB", (math.ceil(width * scale), math.ceil(height * scale)))
+        self.image = ImageOps.exif_transpose(img).convert("RGB")
+        if orientation in _TRANSPOSED_ORIENTATIONS:
+            width, height = height, width
+        # full resolution size as seen by the model, after the EXIF rotation
+        self.full_size = (width, height)
+        self.scale = (width / self.image.width, height / self.image.height)
+        if self.scale == (1, 1):
+            self._full = np.asarray(self.image)
+
+    def _open(self):
+        if isinstance(self.source, (bytes, bytearray)):
+            return Image.open(BytesIO(self.source))
+        return Image.open(self.source)
+
+    def to_original(self, boxes):
+        """
+        Maps boxes [xmin, ymin, xmax, ymax] from the reduced to the full resolution
+        """
+        scale_x, scale_y = self.scale
+        return boxes * np.array([scale_x, scale_y, scale_x, scale_y], dtype=boxes.dtype)
+
+    def get_full(self):
+        """
+        Returns the full resolution image as array, decoded at the first call
+        """
+        if self._full is None:
+            img = ImageOps.exif_transpose(self._open()).convert("RGB")
+            self._full = np.asarray(img)
+        return self._full
+
+    def release(self):
+        """
+        Drops the full resolution image and the source, to be called once the
+        crops are taken
+        """
+        self._full = None
+        self.source = None
 
 
 class YoloModel:
@@ -22,7 +110,10 @@ class YoloModel:
         amp=False,
         agnostic=False,
         max_det=10,
+        batch_size=1,
     ):
+        if yolov5_path is None:
+            yolov5_path = get_local_yolov5_path()
         if yolov5_path is None:
             self.model = torch.hub.load("ultralytics/yolov5", "custom", model_path)
         else:
@@ -42,7 +133,9 @@ class YoloModel:
         self.augment = augment
         self.class_names = class_names
         self.multi_label_iou_threshold = multi_label_iou_threshold
+        self.batch_size = batch_size
         self.results = None
+        self.detections = []
         self.total_inference_time = 0
         self.number_of_inferences = 0
 
@@ -80,187 +173,282 @@ class YoloModel:
         )
 
     def predict(self, input):
+        """
+        Runs inference on one image. input can be a DraftImage, the boxes are
+        then mapped back to the full resolution and crops are taken from it.
+        """
         t0 = time.time()
         self.results = self.model.forward(
-            input, augment=self.augment, size=self.image_size
+            self._model_input(input), augment=self.augment, size=self.image_size
         )
         self.total_inference_time += time.time() - t0
         self.number_of_inferences += 1
+        self.detections = self._decode_results(self.results, [input])
         return self.results
 
-    def get_classes(self):
-        res = self.results
-        classes = res.pandas().xyxy[0]["class"].tolist()
-        return classes
+    def predict_batch(self, images, batch_size=None):
+        """
+        Runs inference on a list of images in micro-batches of batch_size
+        (defaults to self.batch_size). The results of every image are kept and
+        can be accessed with the getters by passing the position of the image
+        in the list as image_index.
 
-    def get_names(self):
-        if self.class_names is None:
-            res = self.results
-            names = res.pandas().xyxy[0]["name"].tolist()
-            return names
-        else:
-            classes = self.get_classes()
-            names = []
-            for i in range(len(classes)):
-                names.append(self.class_names[classes[i]])
-            return names
-
-    def get_scores(self):
-        res = self.results
-        scores = res.pandas().xyxy[0]["confidence"].tolist()
-        return scores
-
-    def get_boxes(self):
-        res = self.results
-        boxes = []
-        for i in range(len(res.pandas().xyxy[0])):
-            box = []
-            box.append(res.pandas().xyxy[0].get("xmin")[i])
-            box.append(res.pandas().xyxy[0].get("ymin")[i])
-            box.append(res.pandas().xyxy[0].get("xmax")[i])
-            box.append(res.pandas().xyxy[0].get("ymax")[i])
-            boxes.append(box)
-
-        return boxes
-
-    def get_indexes(self):
-        boxes = self.get_boxes()
+        Returns a list with the ImageDetections of every image. Images can be
+        DraftImages, see predict.
+        """
+        if batch_size is None:
+            batch_size = self.batch_size
+        detections = []
+        for start in range(0, len(images), batch_size):
+            batch = images[start : start + batch_size]
+            t0 = time.time()
+            self.results = self.model.forward(
+                [self._model_input(image) for image in batch],
+                augment=self.augment,
+                size=self.image_size,
+            )
+            self.total_inference_time += time.time() - t0
+            self.number_of_inferences += len(batch)
+            detections += self._decode_results(self.results, batch)
+        self.detections = detections
+        return self.detections
+
+    def _model_input(self, image):
+        if isinstance(image, DraftImage):
+            return image.image
+        return image
+
+    def _decode_results(self, results, inputs):
+        """
+        Decodes yolov5 results into one ImageDetections per image. Boxes of
+        DraftImage inputs are mapped to the full resolution.
+        """
+        detections = []
+        for i in range(len(results.ims)):
+            pred = results.xyxy[i].cpu().numpy()
+            classes = pred[:, 5].astype(np.int64)
+            class_names = results.names if self.class_names is None else self.class_names
+            boxes = np.ascontiguousarray(pred[:, :4], dtype=np.float32)
+            source = inputs[i] if isinstance(inputs[i], DraftImage) else None
+            if source is not None:
+                boxes = source.to_original(boxes)
+            detections.append(
+                ImageDetections(
+                    boxes=boxes,
+                    scores=pred[:, 4].astype(np.float32),
+                    classes=classes,
+                    names=np.array([class_names[c] for c in classes], dtype=object),
+                    image=results.ims[i],
+                    source=source,
+                )
+            )
+        return detections
+
+    def get_classes(self, image_index=0):
+        return self.detections[image_index].classes
+
+    def get_names(self, image_index=0):
+        return self.detections[image_index].names
+
+    def get_scores(self, image_index=0):
+        return self.detections[image_index].scores
+
+    def get_boxes(self, image_index=0):
+        return self.detections[image_index].boxes
+
+    def get_indexes(self, image_index=0):
+        boxes = self.get_boxes(image_index)
         if self.model.multi_label:
-            overlapping = []
-            for bb1 in range(len(boxes)):
-                overlapping_bb1 = []
-                for bb2 in range(bb1 + 1, len(boxes)):
-                    # for bb2 in range( len(boxes)):
-                    iou = self._compute_iou(boxes[bb1], boxes[bb2])
-                    if iou > self.multi_label_iou_threshold:
-                        overlapping_bb1.append(bb2)
-                overlapping.append(overlapping_bb1)
-            return self._get_overlapping_objects(overlapping)
+            overlapping = compute_iou_matrix(boxes) > self.multi_label_iou_threshold
+            return group_overlapping(overlapping)
         else:
             return [i for i in range(len(boxes))]
 
-    def get_crops(self):
-        res = self.results
+    def get_crops(self, image_index=0):
+        detections = self.detections[image_index]
         crops = []
-        for i in range(len(res.ims)):
-            img_array = res.ims[i]
-            image_width = img_array.shape[1]
-            image_height = img_array.shape[0]
-
-            for coordlist in res.xyxy[i].tolist():
-                x_start = int(coordlist[0])
-                if x_start - self.margin < 0:
-                    x_start = 0
-                else:
-                    x_start = x_start - self.margin
-                y_start = int(coordlist[1])
-                if y_start - self.margin < 0:
-                    y_start = 0
-                else:
-                    y_start = y_start - self.margin
-                x_end = int(coordlist[2])
-                if x_end + self.margin > image_width:
-                    x_end = image_width
-                else:
-                    x_end = x_end + self.margin
-                y_end = int(coordlist[3])
-                if y_end + self.margin > image_height:
-                    y_end = image_height
-                else:
-                    y_end = y_end + self.margin
-                crop = img_array[y_start:y_end, x_start:x_end]
-                crops.append(crop)
+        if detections.source is None:
+            img_array = detections.image
+        elif len(detections) > 0:
+            img_array = detections.source.get_full()
+        else:
+            return crops
+        image_width = img_array.shape[1]
+        image_height = img_array.shape[0]
+
+        for coordlist in detections.boxes:
+            x_start = int(coordlist[0])
+            if x_start - self.margin < 0:
+                x_start = 0
+            else:
+                x_start = x_start - self.margin
+            y_start = int(coordlist[1])
+            if y_start - self.margin < 0:
+                y_start = 0
+            else:
+                y_start = y_start - self.margin
+            x_end = int(coordlist[2])
+            if x_end + self.margin > image_width:
+                x_end = image_width
+            else:
+                x_end = x_end + self.margin
+            y_end = int(coordlist[3])
+            if y_end + self.margin > image_height:
+                y_end = image_height
+            else:
+                y_end = y_end + self.margin
+            crop = img_array[y_start:y_end, x_start:x_end]
+            if detections.source is not None:
+                # copied, so the full resolution can be released after the crops are taken
+                crop = crop.copy()
+            crops.append(crop)
         return crops
 
-    # https://stackoverflow.com/a/42874377
-    def _compute_iou(self, bb1, bb2):
-        """
-        Calculate the Intersection over Union (IoU) of two bounding boxes.
-
-        Parameters
-        ----------
-        bb1 : list
-            box format: [xmin, ymin, xmax, ymax]
-
-        bb2 : list
-            box format: [xmin, ymin, xmax, ymax]
-
-        Returns
-        -------
-        float
-            in [0, 1]
 
+def compute_iou_matrix(boxes):
+    """
+    Calculate the Intersection over Union (IoU) of all pairs of bounding boxes.
+
+    Parameters
+    ----------
+    boxes : np.ndarray
+        (n, 4) boxes, format: [xmin, ymin, xmax, ymax]
+
+    Returns
+    -------
+    np.ndarray
+        (n, n) IoU values in [0, 1]
+    """
+    boxes = np.asarray(boxes)
+    x_left = np.maximum(boxes[:, None, 0], boxes[None, :, 0])
+    y_top = np.maximum(boxes[:, None, 1], boxes[None, :, 1])
+    x_right = np.minimum(boxes[:, None, 2], boxes[None, :, 2])
+    y_bottom = np.minimum(boxes[:, None, 3], boxes[None, :, 3])
+    # The intersection of two axis-aligned bounding boxes is always an
+    # axis-aligned bounding box, empty if they do not overlap
+    intersection_area = np.clip(x_right - x_left, 0, None) * np.clip(y_bottom - y_top, 0, None)
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    union_area = (areas[:, None] + areas[None, :] - intersection_area).astype(np.float64)
+    iou = np.zeros(union_area.shape, dtype=np.float64)
+    np.divide(intersection_area, union_area, out=iou, where=union_area > 0)
+    return iou
+
+
+def group_overlapping(overlapping):
+    """
+    Groups objects which overlap directly or transitively (connected
+    components) with a union-find.
+
+    Parameters
+    ----------
+    overlapping : np.ndarray
+        (n, n) boolean matrix, True where two objects overlap
+
+    Returns
+    -------
+    list
+        group index of every object, groups are numbered in the order of
+        their first object
+    """
+    n = len(overlapping)
+    parents = list(range(n))
+
+    def find(i):
+        root = i
+        while parents[root] != root:
+            root = parents[root]
+        # path compression
+        while parents[i] != root:
+            parents[i], i = root, parents[i]
+        return root
+
+    for i, j in zip(*np.nonzero(np.triu(overlapping, 1))):
+        root_i, root_j = find(i), find(j)
+        # the smallest index is the root of its group
+        if root_i < root_j:
+            parents[root_j] = root_i
+        elif root_j < root_i:
+            parents[root_i] = root_j
+
+    groups = {}
+    indexes = []
+    for i in range(n):
+        indexes.append(groups.setdefault(find(i), len(groups)))
+    return indexes
+
+
+def get_local_yolov5_path():
+    """
+    Returns a local yolov5 repository which can be used by torch.hub without
+    network access: the YOLOV5_PATH environment variable or the cached
+    ultralytics/yolov5 checkout in the torch hub directory. None if neither exists.
+    """
+    candidates = [
+        os.environ.get("YOLOV5_PATH"),
+        os.path.join(torch.hub.get_dir(), "ultralytics_yolov5_master"),
+    ]
+    for path in candidates:
+        if path is not None and os.path.isfile(os.path.join(path, "hubconf.py")):
+            return path
+    return None
+
+
+def load_model(model_path, yolov5_path=None, **kwargs):
+    """
+    Returns a YoloModel for the given weights and configuration (keyword
+    arguments of YoloModel). Each model is loaded at most once per process,
+    later calls with the same weights path and configuration reuse it.
+    """
+    config_hash = hashlib.sha1(
+        json.dumps(
+            {"yolov5_path": yolov5_path, **kwargs}, sort_keys=True, default=str
+        ).encode("utf-8")
+    ).hexdigest()
+    key = (os.path.abspath(model_path), config_hash)
+    with _MODEL_REGISTRY_LOCK:
+        model = _MODEL_REGISTRY.get(key)
+        if model is None:
+            logging.info("Loading model %s", model_path)
+            model = YoloModel(model_path, yolov5_path=yolov5_path, **kwargs)
+            _MODEL_REGISTRY[key] = model
+    return model
+
+
+class CropCollector:
+    """
+    Collects crops (e.g. all flower crops of a batch of images) under a key and
+    runs a model on all of them at once. The crops are sorted by aspect ratio
+    before batching, so every micro-batch is letterboxed to a similar shape and
+    needs as little padding as possible.
+    """
+
+    def __init__(self):
+        self.keys = []
+        self.crops = []
+        self.image_indexes = {}
+
+    def __len__(self):
+        return len(self.crops)
+
+    def add(self, key, crop):
+        self.keys.append(key)
+        self.crops.append(crop)
+
+    def predict(self, model, batch_size=None):
         """
-
-        assert bb1[0] < bb1[2]
-        assert bb1[1] < bb1[3]
-        assert bb2[0] < bb2[2]
-        assert bb2[1] < bb2[3]
-
-        # determine the coordinates of the intersection rectangle
-        x_left = max(bb1[0], bb2[0])
-        y_top = max(bb1[1], bb2[1])
-        x_right = min(bb1[2], bb2[2])
-        y_bottom = min(bb1[3], bb2[3])
-
-        if x_right < x_left or y_bottom < y_top:
-            return 0.0
-
-        # The intersection of two axis-aligned bounding boxes is always an
-        # axis-aligned bounding box
-        intersection_area = (x_right - x_left) * (y_bottom - y_top)
-
-        # compute the area of both AABBs
-        bb1_area = (bb1[2] - bb1[0]) * (bb1[3] - bb1[1])
-        bb2_area = (bb2[2] - bb2[0]) * (bb2[3] - bb2[1])
-
-        # compute the intersection over union by taking the intersection
-        # area and dividing it by the sum of prediction + ground-truth
-        # areas - the interesection area
-        iou = intersection_area / float(bb1_area + bb2_area - intersection_area)
-        assert iou >= 0.0
-        assert iou <= 1.0
-        return iou
-
-    def _get_overlapping_objects(self, overlapping):
-        """
-        Get the overlapping objects from a list of overlapping objects.
+        Runs model.predict_batch on all collected crops. Returns a dict (in the
+        order the crops were added) which maps every key to the image_index of
+        its crop, to be passed to the getters of the model.
         """
-        indexes = []
-        known_ids = []
-        new_indexes = [0 for i in range(len(overlapping))]
-        for i in range(len(overlapping)):
-            if i not in known_ids:
-                idx = self._get_related_elements(overlapping, i, [i])
-                known_ids += idx
-                indexes.append(idx)
-
-        for i in range(len(indexes)):
-            for j in range(len(indexes[i])):
-                new_indexes[indexes[i][j]] = i
-
-        return new_indexes
-
-    def _get_related_elements(self, list, index, known_elements=[]):
-        elements = known_elements
-        # if not index in elements:
-        #    elements.append(index)
-
-        for item in list[index]:
-            if item not in elements:
-                elements.append(item)
-                # print("append ",item,"to",elements)
-                additional_elements = self._get_related_elements(list, item, elements)
-                for element in additional_elements:
-                    if element not in elements:
-                        elements.append(element)
-                        # print("append ",element,"to",elements)
-
-        for i in range(len(list)):
-            for item in list[i]:
-                if item in elements:
-                    if i not in elements:
-                        # print("append ",i,"to",elements)
-                        elements.append(i)
-
-        return sorted(elements)
+        order = sorted(
+            range(len(self.crops)),
+            key=lambda i: self.crops[i].shape[1] / max(self.crops[i].shape[0], 1),
+        )
+        model.predict_batch([self.crops[i] for i in order], batch_size)
+        positions = [0] * len(order)
+        for image_index, i in enumerate(order):
+            positions[i] = image_index
+        self.image_indexes = {
+            key: positions[i] for i, key in enumerate(self.keys)
+        }
+        return self.image_indexes
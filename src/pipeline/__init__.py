@@ -1,4 +1,7 @@
 from .extract import *
 from .transform import *
 from .load import *
-from .clients import *
\ No newline at end of file
+from .clients import *
+from .pipelining import *
+from .workers import *
+from .autotune import *
\ No newline at end of file
@@ -0,0 +1,218 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+
+
+class BatchAutotuner:
+    """
+    Adjusts the batch size and the number of download threads from the throughput measured over
+    the recent batches. Both values are hill-climbed: a step is kept while the measured throughput
+    (images/s end-to-end for the batch size, MB/s for the download threads) improves, otherwise the
+    direction is reversed. The batch size is bounded by min/max_batch_size and by the memory
+    ceiling, estimated from the average object size of the downloaded files.
+
+    The state and the measurements can be persisted to a JSON file (metrics_path), which is read
+    again at the next start, so the tuning carries over between flow runs.
+    """
+
+    # relative throughput change which counts as improvement
+    TOLERANCE = 0.05
+    STEP = 1.5
+
+    def __init__(
+        self,
+        batch_size: int = 64,
+        min_batch_size: int = 8,
+        max_batch_size: int = 512,
+        n_threads: int = 8,
+        min_threads: int = 1,
+        max_threads: int = 32,
+        max_memory_mb: float = None,
+        window: int = 3,
+        metrics_path: str = None
+    ):
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.min_threads = min_threads
+        self.max_threads = max_threads
+        self.max_memory_mb = max_memory_mb
+        self.metrics_path = metrics_path
+        self.batch_size = batch_size
+        self.n_threads = n_threads
+        # +1 grows, -1 shrinks the value at the next step
+        self.batch_size_direction = 1
+        self.n_threads_direction = 1
+        # recent batches measured with the current values
+        self.batches = deque(maxlen=window)
+        self.current = None
+        self.last_batch_throughput = None
+        self.last_download_throughput = None
+        # average size of the downloaded objects
+        self.object_mb = 0
+        # throughput of the stages over the last window
+        self.stage_throughput = {}
+        self.lock = threading.Lock()
+        if metrics_path is not None and os.path.exists(metrics_path):
+            self._restore(metrics_path)
+        self.batch_size = self._clamp(self.batch_size, self.min_batch_size, self._max_batch_size())
+        self.n_threads = self._clamp(self.n_threads, self.min_threads, self.max_threads)
+
+    @staticmethod
+    def _clamp(value, lower, upper):
+        return int(max(lower, min(value, upper)))
+
+    def _restore(self, path: str):
+        try:
+            with open(path, 'r') as json_file:
+                state = json.load(json_file)
+            self.batch_size = state['batch_size']
+            self.n_threads = state['n_threads']
+            self.batch_size_direction = state.get('batch_size_direction', 1)
+            self.n_threads_direction = state.get('n_threads_direction', 1)
+            self.last_batch_throughput = state.get('batch_images_per_s')
+            self.last_download_throughput = state.get('download_mb_per_s')
+            self.object_mb = state.get('object_mb', 0)
+            self.stage_throughput = {
+                key: state[key] for key in ['inference_images_per_s', 'load_rows_per_s'] if state.get(key) is not None
+            }
+            # batches of previous runs measured with the current values
+            self.batches.extend(
+                batch for batch in state.get('pending_batches', [])
+                if batch.get('batch_size') == self.batch_size and batch.get('n_threads') == self.n_threads
+            )
+        except (OSError, ValueError, KeyError) as e:
+            print(e, f'Could not restore autotuner state from {path}')
+
+    def _max_batch_size(self) -> int:
+        """Upper bound of the batch size given the memory ceiling."""
+        if self.max_memory_mb is None or self.object_mb <= 0:
+            return self.max_batch_size
+        return max(self.min_batch_size, min(self.max_batch_size, int(self.max_memory_mb / self.object_mb)))
+
+    def start_batch(self):
+        """Starts the measurements of a batch."""
+        with self.lock:
+            self.current = {
+                'started_at': time.perf_counter(),
+                'batch_size': self.batch_size,
+                'n_threads': self.n_threads,
+            }
+
+    def record(self, stage: str, seconds: float, items: int, n_bytes: int = 0):
+        """
+        Adds a measurement of a stage ('download', 'inference' or 'load') to the current batch.
+        Thread-safe, stages of the streaming mode record concurrently.
+        """
+        with self.lock:
+            if self.current is None:
+                return
+            for key, value in [('seconds', seconds), ('items', items), ('bytes', n_bytes)]:
+                self.current[f'{stage}_{key}'] = self.current.get(f'{stage}_{key}', 0) + value
+
+    def end_batch(self, n_images: int):
+        """
+        Finishes the measurements of the current batch and tunes batch size and download threads
+        once window batches were measured with the current values. The state is saved after every
+        batch, so the window also fills up over consecutive flow runs of one batch each.
+        """
+        with self.lock:
+            if self.current is None:
+                return
+            batch = self.current
+            self.current = None
+            batch['seconds'] = time.perf_counter() - batch.pop('started_at')
+            batch['images'] = n_images
+            if n_images < batch['batch_size']:
+                # partial batches (no more data) say nothing about the batch size
+                return
+            self.batches.append(batch)
+            if len(self.batches) == self.batches.maxlen:
+                self._tune()
+                self.batches.clear()
+        self.save()
+
+    def _average(self, numerator: str, denominator: str) -> float:
+        total = sum(batch.get(denominator, 0) for batch in self.batches)
+        if total <= 0:
+            return 0
+        return sum(batch.get(numerator, 0) for batch in self.batches) / total
+
+    def _step(self, value: int, direction: int, lower: int, upper: int) -> int:
+        if direction > 0:
+            return self._clamp(max(value * self.STEP, value + 1), lower, upper)
+        return self._clamp(min(value / self.STEP, value - 1), lower, upper)
+
+    def _tune(self):
+        batch_throughput = self._average('images', 'seconds')
+        download_throughput = self._average('download_bytes', 'download_seconds') / 1024 / 1024
+        if self._average('download_bytes', 'download_items') > 0:
+            self.object_mb = self._average('download_bytes', 'download_items') / 1024 / 1024
+        self.stage_throughput = {
+            'download_mb_per_s': download_throughput,
+            'inference_images_per_s': self._average('inference_items', 'inference_seconds'),
+            'load_rows_per_s': self._average('load_items', 'load_seconds'),
+        }
+
+        if self.last_batch_throughput is not None and \
+                batch_throughput < self.last_batch_throughput * (1 + self.TOLERANCE):
+            self.batch_size_direction *= -1
+        new_batch_size = self._step(
+            self.batch_size, self.batch_size_direction, self.min_batch_size, self._max_batch_size()
+        )
+        if new_batch_size == self.batch_size:
+            # at a bound, try the other direction next time
+            self.batch_size_direction *= -1
+        self.batch_size = new_batch_size
+        self.last_batch_throughput = batch_throughput
+
+        if download_throughput > 0:
+            if self.last_download_throughput is not None and \
+                    download_throughput < self.last_download_throughput * (1 + self.TOLERANCE):
+                self.n_threads_direction *= -1
+            new_n_threads = self._step(
+                self.n_threads, self.n_threads_direction, self.min_threads, self.max_threads
+            )
+            if new_n_threads == self.n_threads:
+                self.n_threads_direction *= -1
+            self.n_threads = new_n_threads
+            self.last_download_throughput = download_throughput
+
+        print(
+            f'Autotuner: {batch_throughput:.2f} images/s, {download_throughput:.2f} MB/s download, '
+            f'next batch size {self.batch_size}, download threads {self.n_threads}'
+        )
+
+    def get_metrics(self) -> dict:
+        """
+        Returns the chosen values and the throughput of the stages over the last window.
+        """
+        with self.lock:
+            return {
+                'batch_size': self.batch_size,
+                'n_threads': self.n_threads,
+                'batch_size_direction': self.batch_size_direction,
+                'n_threads_direction': self.n_threads_direction,
+                'batch_images_per_s': self.last_batch_throughput,
+                'download_mb_per_s': self.last_download_throughput,
+                'inference_images_per_s': self.stage_throughput.get('inference_images_per_s'),
+                'load_rows_per_s': self.stage_throughput.get('load_rows_per_s'),
+                'object_mb': self.object_mb,
+                'max_batch_size': self._max_batch_size(),
+                'updated_at': time.time(),
+            }
+
+    def save(self):
+        """
+        Writes get_metrics and the measurements of the pending window to metrics_path, if given.
+        """
+        if self.metrics_path is None:
+            return
+        metrics = self.get_metrics()
+        with self.lock:
+            metrics['pending_batches'] = list(self.batches)
+        tmp_path = self.metrics_path + '.tmp'
+        with open(tmp_path, 'w') as json_file:
+            json.dump(metrics, json_file, indent=2)
+        os.replace(tmp_path, self.metrics_path)
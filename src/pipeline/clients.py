@@ -1,9 +1,20 @@
 import yaml
+import select
+import threading
+import time
+from contextlib import contextmanager
 
 import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from psycopg2.pool import ThreadedConnectionPool
 from minio import Minio
 
 
+# process-level connection pools, see get_db_pool
+_DB_POOLS = {}
+_DB_POOLS_LOCK = threading.Lock()
+
+
 def edit_schema(db_schema: str = None, n: int = 20) -> list:
     """
     Applies a string operation on db_schema and creates a list of n db_schema elements.
@@ -58,24 +69,218 @@ def get_db_client(config_path: str) -> object:
         user=config['POSTGRES_USER'],
         password=config['POSTGRES_PASSWORD']
     )
-    db_schema = edit_schema(db_schema=config['DB_SCHEMA'], n=1)
+    if not is_connection_alive(conn):
+        raise ConnectionError('Could not connect to DB')
+
+    return conn
+
+
+def is_connection_alive(conn: object) -> bool:
+    """
+    Checks a DB connection with a cheap query.
+
+    Parameters
+    ----------
+    conn : object
+        psycopg2 connection
+
+    Returns
+    -------
+    bool
+        True if the connection is usable
+    """
+    if conn.closed:
+        return False
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        conn.rollback()
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        return False
+    return True
+
+
+class DBConnectionPool:
+    """
+    Thread-safe pool of psycopg2 connections. getconn blocks while all connections are in use.
+    Connections are checked with a liveness query when taken from the pool and replaced if stale.
+    """
+
+    def __init__(self, minconn: int = 1, maxconn: int = 4, **connect_kwargs):
+        self.pool = ThreadedConnectionPool(minconn, maxconn, **connect_kwargs)
+        self.semaphore = threading.BoundedSemaphore(maxconn)
 
-    with conn.cursor() as cursor:    
-        # Perform simple query to check connection
+    def getconn(self) -> object:
+        self.semaphore.acquire()
         try:
-            cursor.execute(
-                """
-                SELECT * FROM {}files_image
-                LIMIT 10
-                """.format(*db_schema)
-            )
-        except ConnectionError:
+            conn = self.pool.getconn()
+            if not is_connection_alive(conn):
+                # stale connection, e.g. after a server restart or network timeout
+                self.pool.putconn(conn, close=True)
+                conn = self.pool.getconn()
+        except Exception:
+            self.semaphore.release()
             raise ConnectionError('Could not connect to DB')
-        data = cursor.fetchall()
-        if len(data) < 1:
-            raise Exception(f'Bad return Value: {data}')
+        return conn
+
+    def putconn(self, conn: object):
+        self.pool.putconn(conn, close=bool(conn.closed))
+        self.semaphore.release()
+
+    @contextmanager
+    def connection(self):
+        """Context manager which takes a connection from the pool and returns it afterwards."""
+        conn = self.getconn()
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def closeall(self):
+        self.pool.closeall()
+
+
+def get_db_pool(config_path: str, minconn: int = 1, maxconn: int = 4) -> DBConnectionPool:
+    """
+    Returns a DB connection pool. Pools are created once per process and configuration
+    and shared by all flow runs and threads.
+
+    Parameters
+    ----------
+    config_path : str
+        Path where the config vars for the DB are stored in.
+
+    minconn : int, optional
+        connections kept open, by default 1
+
+    maxconn : int, optional
+        maximum number of connections, by default 4
+
+    Returns
+    -------
+    DBConnectionPool
+    """
+    with open(config_path, 'rb') as yaml_file:
+        config = yaml.load(yaml_file, yaml.FullLoader)
+
+    connect_kwargs = dict(
+        host=config['DB_HOST'],
+        port=config['DB_PORT'],
+        database=config['DB_NAME'],
+        user=config['POSTGRES_USER'],
+        password=config['POSTGRES_PASSWORD'],
+        # detect dead connections of idle pools
+        keepalives=1,
+        keepalives_idle=30,
+    )
+    key = (config['DB_HOST'], config['DB_PORT'], config['DB_NAME'], config['POSTGRES_USER'], minconn, maxconn)
+    with _DB_POOLS_LOCK:
+        pool = _DB_POOLS.get(key)
+        if pool is None:
+            try:
+                pool = DBConnectionPool(minconn=minconn, maxconn=maxconn, **connect_kwargs)
+            except psycopg2.OperationalError:
+                raise ConnectionError('Could not connect to DB')
+            _DB_POOLS[key] = pool
+
+    return pool
+
+
+class FileNotificationListener:
+    """
+    Listens for the file_ids of new files_image rows (see ensure_notify_trigger) on a dedicated
+    autocommit connection. Notifications sent while the connection was lost are missed, reconnected
+    is set to True after a reconnect so the caller can run a reconciliation sweep.
+    """
+
+    def __init__(self, channel: str = 'files_image_insert', **connect_kwargs):
+        self.channel = channel
+        self.connect_kwargs = connect_kwargs
+        self.conn = None
+        self.file_ids = set()
+        self.reconnected = False
+        self._connect()
+
+    def _connect(self):
+        self.conn = psycopg2.connect(**self.connect_kwargs)
+        self.conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        with self.conn.cursor() as cursor:
+            cursor.execute('LISTEN {}'.format(self.channel))
+
+    def _collect(self):
+        self.conn.poll()
+        while self.conn.notifies:
+            notify = self.conn.notifies.pop(0)
+            for file_id in notify.payload.split(','):
+                if file_id.strip().isdigit():
+                    self.file_ids.add(int(file_id))
+
+    def wait(self, timeout: float) -> bool:
+        """
+        Waits up to timeout seconds for notifications. Returns True if there are notified file_ids.
+        """
+        try:
+            if len(self.file_ids) == 0:
+                select.select([self.conn], [], [], timeout)
+            self._collect()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            try:
+                self.conn.close()
+                self._connect()
+                self.reconnected = True
+            except psycopg2.OperationalError:
+                # try again at the next call
+                time.sleep(timeout)
+        return len(self.file_ids) > 0
+
+    def get_file_ids(self) -> set:
+        """
+        Returns and clears the notified file_ids
+        """
+        self.wait(0)
+        file_ids, self.file_ids = self.file_ids, set()
+        return file_ids
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+
+
+def get_db_listener(config_path: str, channel: str = 'files_image_insert') -> FileNotificationListener:
+    """
+    Initiates a listener for notifications of new files_image rows.
+
+    Parameters
+    ----------
+    config_path : str
+        Path where the config vars for the DB are stored in.
+
+    channel : str, optional
+        notification channel, by default 'files_image_insert'
+
+    Returns
+    -------
+    FileNotificationListener
+    """
+    with open(config_path, 'rb') as yaml_file:
+        config = yaml.load(yaml_file, yaml.FullLoader)
+
+    try:
+        listener = FileNotificationListener(
+            channel=channel,
+            host=config['DB_HOST'],
+            port=config['DB_PORT'],
+            database=config['DB_NAME'],
+            user=config['POSTGRES_USER'],
+            password=config['POSTGRES_PASSWORD'],
+            keepalives=1,
+            keepalives_idle=30,
+        )
+    except psycopg2.OperationalError:
+        raise ConnectionError('Could not connect to DB')
+
+    return listener
 
-    return conn
 
 def get_minio_client(config_path: str) -> object:
     """
@@ -1,6 +1,8 @@
 import yaml
 import os
+import socket
 import time
+import threading
 
 import pandas as pd
 import numpy as np
@@ -14,13 +16,141 @@ from .clients import get_db_client, edit_schema
 
 
 
+@task(name='Ensure checkpoint indexes and tables')
+def ensure_checkpoint_schema(conn: object, db_schema: str = None, use_high_water_mark: bool = True,
+                             use_claims: bool = False):
+    """
+    Creates the index on image_results (config_id, file_id) used by the anti-join of get_checkpoint,
+    with use_high_water_mark the table pollinator_checkpoints, which persists the high-water mark per
+    model configuration, and with use_claims the table pollinator_file_claims, which holds the files
+    leased by workers (see claim_checkpoint). Existing objects are left untouched and no DDL is run for
+    them, so a role without CREATE privilege can run the flow once the objects exist.
+
+    Parameters
+    ----------
+    conn : object
+        psycopg2 database client
+
+    db_schema: str, optional
+        defines the database schema to use, default None
+
+    use_high_water_mark : bool, optional
+        if True ensures the table pollinator_checkpoints, by default True
+
+    use_claims : bool, optional
+        if True ensures the table pollinator_file_claims, by default False
+    """
+    db_schema = edit_schema(db_schema=db_schema, n=4)
+
+    def _exists(cursor, name):
+        # check first, CREATE ... IF NOT EXISTS needs the CREATE privilege (and CREATE INDEX
+        # locks the table) even if the object exists
+        cursor.execute("SELECT to_regclass(%s)", (name,))
+        return cursor.fetchone()[0] is not None
+
+    try:
+        with conn.cursor() as cursor:
+            if not _exists(cursor, '{}image_results_config_id_file_id_idx'.format(db_schema[0])):
+                cursor.execute(
+                    """
+                    CREATE INDEX IF NOT EXISTS image_results_config_id_file_id_idx
+                    ON {}image_results (config_id, file_id)
+                    """.format(db_schema[1])
+                )
+            if use_high_water_mark and not _exists(cursor, '{}pollinator_checkpoints'.format(db_schema[2])):
+                cursor.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS {}pollinator_checkpoints (
+                        config_id varchar PRIMARY KEY,
+                        last_file_id bigint NOT NULL,
+                        updated_at timestamptz NOT NULL DEFAULT now()
+                    )
+                    """.format(db_schema[2])
+                )
+            if use_claims and not _exists(cursor, '{}pollinator_file_claims'.format(db_schema[3])):
+                cursor.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS {}pollinator_file_claims (
+                        file_id bigint NOT NULL,
+                        config_id varchar NOT NULL,
+                        worker_id varchar NOT NULL,
+                        claimed_at timestamptz NOT NULL DEFAULT now(),
+                        expires_at timestamptz NOT NULL,
+                        PRIMARY KEY (config_id, file_id)
+                    )
+                    """.format(db_schema[3])
+                )
+    except Exception:
+        conn.rollback()
+        raise Exception('Could not create checkpoint indexes and tables.')
+    finally:
+        conn.commit()
+
+
+@task(name='Ensure notify trigger on files_image')
+def ensure_notify_trigger(conn: object, db_schema: str = None, channel: str = 'files_image_insert'):
+    """
+    Creates a trigger on files_image which sends the file_id of every inserted row as notification
+    on channel (pg_notify), see FileNotificationListener. Requires the privilege to create triggers
+    on files_image. Existing objects are left untouched.
+
+    Parameters
+    ----------
+    conn : object
+        psycopg2 database client
+
+    db_schema: str, optional
+        defines the database schema to use, default None
+
+    channel : str, optional
+        notification channel, by default 'files_image_insert'
+    """
+    db_schema = edit_schema(db_schema=db_schema, n=4)
+
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT 1 FROM pg_trigger
+                WHERE tgname = 'files_image_notify_insert' AND tgrelid = to_regclass(%s)
+                """,
+                ('{}files_image'.format(db_schema[0]),)
+            )
+            if cursor.fetchone() is None:
+                cursor.execute(
+                    """
+                    CREATE OR REPLACE FUNCTION {}files_image_notify_insert() RETURNS trigger AS $$
+                    BEGIN
+                        PERFORM pg_notify('{}', NEW.file_id::text);
+                        RETURN NEW;
+                    END;
+                    $$ LANGUAGE plpgsql
+                    """.format(db_schema[1], channel)
+                )
+                cursor.execute(
+                    """
+                    CREATE TRIGGER files_image_notify_insert
+                    AFTER INSERT ON {}files_image
+                    FOR EACH ROW EXECUTE FUNCTION {}files_image_notify_insert()
+                    """.format(db_schema[2], db_schema[3])
+                )
+    except Exception:
+        conn.rollback()
+        raise Exception('Could not create notify trigger.')
+    finally:
+        conn.commit()
+
+
 @task(
     name='Get checkpoint of unprocessed images',
 )
-def get_checkpoint(conn: object, request_batch_size: int, model_config_id: str, db_schema: str = None) -> pd.DataFrame:
+def get_checkpoint(conn: object, request_batch_size: int, model_config_id: str, db_schema: str = None, 
+                   use_high_water_mark: bool = True, file_ids: list = None,
+                   high_water_mark_lag: int = 1000) -> pd.DataFrame:
     """
     Returns checkpoint for data processing. Queries data from db files_image table which not have been processed by given 
-    model configuration.
+    model configuration, ordered by file_id. With use_high_water_mark only files after the persisted 
+    high-water mark of the model configuration minus high_water_mark_lag are scanned (see db_update_checkpoint).
 
     Parameters
     ----------
@@ -36,6 +166,18 @@ def get_checkpoint(conn: object, request_batch_size: int, model_config_id: str,
     db_schema: str, optional
         defines the database schema to use, default None
 
+    use_high_water_mark : bool, optional
+        if True scans only files after the high-water mark, else the whole table, by default True
+
+    file_ids : list, optional
+        if given only these files are considered (e.g. notified by FileNotificationListener) and
+        the table is not scanned, by default None
+
+    high_water_mark_lag : int, optional
+        number of file_ids below the high-water mark which are scanned again. file_ids are assigned
+        before the insert commits, a file with a lower file_id committed after the high-water mark
+        passed it is picked up as long as it is within the lag, by default 1000
+
     Returns
     -------
     pd.DataFrame
@@ -45,41 +187,53 @@ def get_checkpoint(conn: object, request_batch_size: int, model_config_id: str,
         model_config_id = model_config_id.replace('\n', '')
     print('Current Model Config ID:', model_config_id)
     
-    db_schema = edit_schema(db_schema=db_schema, n=6)
+    db_schema = edit_schema(db_schema=db_schema, n=3)
+
+    if file_ids is not None:
+        file_filter = 'f.file_id = ANY(%(file_ids)s)'
+    elif use_high_water_mark:
+        file_filter = """
+            f.file_id > COALESCE((
+                SELECT last_file_id FROM {}pollinator_checkpoints
+                WHERE config_id = %(config_id)s
+            ), 0) - %(lag)s
+            """.format(db_schema[2])
+    else:
+        file_filter = 'f.file_id > 0'
 
     try:
         with conn.cursor() as cursor:
             cursor.execute(
                 """
                 SELECT
-                    DISTINCT ON ({}files_image.file_id) 
-                    {}files_image.file_id,
-                    {}files_image.object_name,
-                    tmp_table.result_id,
-                    tmp_table.config_id
+                    f.file_id,
+                    f.object_name
                 FROM
-                    {}files_image
-                    LEFT JOIN (
-                        SELECT
-                            result_id,
-                            config_id,
-                            file_id
-                        FROM
-                            {}image_results
-                        WHERE
-                            config_id = %s
-                    ) AS tmp_table ON tmp_table.file_id = {}files_image.file_id
+                    {}files_image AS f
                 WHERE
-                    tmp_table.config_id IS NULL
+                    {}
+                    AND NOT EXISTS (
+                        SELECT 1 FROM {}image_results AS r
+                        WHERE r.config_id = %(config_id)s AND r.file_id = f.file_id
+                    )
+                ORDER BY
+                    f.file_id
                 LIMIT
-                    %s
-                """.format(*db_schema),
-                (model_config_id, request_batch_size)
+                    %(limit)s
+                """.format(db_schema[0], file_filter, db_schema[1]),
+                {
+                    'config_id': model_config_id,
+                    'limit': request_batch_size,
+                    'file_ids': [int(file_id) for file_id in file_ids or []],
+                    'lag': high_water_mark_lag
+                }
             )
             data = cursor.fetchall()
             colnames = [desc[0] for desc in cursor.description]
     except Exception:
         raise Exception('Could not retrieve data from DB.')
+    finally:
+        conn.commit()
 
     return pd.DataFrame.from_records(
         data=data,
@@ -87,6 +241,175 @@ def get_checkpoint(conn: object, request_batch_size: int, model_config_id: str,
     )
 
 
+def get_worker_id() -> str:
+    """
+    Returns an ID of this worker process for claims, <hostname>-<pid>.
+    """
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+@task(
+    name='Claim checkpoint of unprocessed images',
+)
+def claim_checkpoint(conn: object, request_batch_size: int, model_config_id: str, worker_id: str,
+                     lease_seconds: int = 900, db_schema: str = None, use_high_water_mark: bool = True,
+                     file_ids: list = None, high_water_mark_lag: int = 1000) -> pd.DataFrame:
+    """
+    Like get_checkpoint, but leases the returned files to worker_id, so concurrent workers process
+    disjoint batches. Files with an active claim of any worker are skipped and the claim insert only
+    takes over expired claims: a concurrent claim of the same file waits on the primary key of
+    pollinator_file_claims and returns nothing once the first one committed, so a file is never
+    leased twice at a time. No rows of files_image are locked, which would require UPDATE privilege
+    on it and block the updates of the ingest. Claims of crashed workers expire after lease_seconds
+    and the files are claimed again. Claims are removed with db_release_claims.
+
+    Parameters
+    ----------
+    conn : object
+        psycopg2 database client
+
+    request_batch_size : int
+        batch size to process at each iteration
+
+    model_config_id : str
+        model configuration ID.
+
+    worker_id : str
+        ID of the claiming worker, see get_worker_id
+
+    lease_seconds : int, optional
+        duration of the claim, has to be longer than processing a batch, by default 900
+
+    db_schema: str, optional
+        defines the database schema to use, default None
+
+    use_high_water_mark : bool, optional
+        if True scans only files after the high-water mark, else the whole table, by default True
+
+    file_ids : list, optional
+        if given only these files are considered (e.g. notified by FileNotificationListener) and
+        the table is not scanned, by default None
+
+    high_water_mark_lag : int, optional
+        number of file_ids below the high-water mark which are scanned again. file_ids are assigned
+        before the insert commits, a file with a lower file_id committed after the high-water mark
+        passed it is picked up as long as it is within the lag, by default 1000
+
+    Returns
+    -------
+    pd.DataFrame
+        dataframe with the claimed objects for this iteration
+    """
+    if '\n' in model_config_id:
+        model_config_id = model_config_id.replace('\n', '')
+    print('Current Model Config ID:', model_config_id, 'Worker ID:', worker_id)
+
+    db_schema = edit_schema(db_schema=db_schema, n=5)
+
+    if file_ids is not None:
+        file_filter = 'f.file_id = ANY(%(file_ids)s)'
+    elif use_high_water_mark:
+        file_filter = """
+            f.file_id > COALESCE((
+                SELECT last_file_id FROM {}pollinator_checkpoints
+                WHERE config_id = %(config_id)s
+            ), 0) - %(lag)s
+            """.format(db_schema[2])
+    else:
+        file_filter = 'f.file_id > 0'
+
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                WITH candidates AS (
+                    SELECT
+                        f.file_id,
+                        f.object_name
+                    FROM
+                        {}files_image AS f
+                    WHERE
+                        {}
+                        AND NOT EXISTS (
+                            SELECT 1 FROM {}image_results AS r
+                            WHERE r.config_id = %(config_id)s AND r.file_id = f.file_id
+                        )
+                        AND NOT EXISTS (
+                            SELECT 1 FROM {}pollinator_file_claims AS c
+                            WHERE c.config_id = %(config_id)s AND c.file_id = f.file_id
+                            AND c.expires_at > now()
+                        )
+                    ORDER BY
+                        f.file_id
+                    LIMIT
+                        %(limit)s
+                ), claimed AS (
+                    INSERT INTO {}pollinator_file_claims AS c (file_id, config_id, worker_id, claimed_at, expires_at)
+                    SELECT file_id, %(config_id)s, %(worker_id)s, now(), now() + make_interval(secs => %(lease)s)
+                    FROM candidates
+                    ON CONFLICT (config_id, file_id) DO UPDATE
+                    SET worker_id = EXCLUDED.worker_id, claimed_at = EXCLUDED.claimed_at,
+                        expires_at = EXCLUDED.expires_at
+                    WHERE c.expires_at <= now()
+                    RETURNING c.file_id
+                )
+                SELECT
+                    candidates.file_id,
+                    candidates.object_name
+                FROM
+                    candidates JOIN claimed ON claimed.file_id = candidates.file_id
+                ORDER BY
+                    candidates.file_id
+                """.format(db_schema[0], file_filter, db_schema[1], db_schema[3], db_schema[4]),
+                {
+                    'config_id': model_config_id,
+                    'worker_id': worker_id,
+                    'lease': lease_seconds,
+                    'limit': request_batch_size,
+                    'file_ids': [int(file_id) for file_id in file_ids or []],
+                    'lag': high_water_mark_lag
+                }
+            )
+            data = cursor.fetchall()
+            colnames = [desc[0] for desc in cursor.description]
+    except Exception:
+        conn.rollback()
+        raise Exception('Could not claim data from DB.')
+    finally:
+        conn.commit()
+
+    return pd.DataFrame.from_records(
+        data=data,
+        columns=colnames
+    )
+
+
+def get_high_water_mark(requested_file_ids: list, processed_file_ids: list) -> int:
+    """
+    Returns the highest requested file_id up to which all requested file_ids were processed.
+
+    Parameters
+    ----------
+    requested_file_ids : list
+        file_ids returned by get_checkpoint
+
+    processed_file_ids : list
+        file_ids which were inserted into image_results
+
+    Returns
+    -------
+    int
+        high-water mark or None if the lowest requested file_id was not processed
+    """
+    processed_file_ids = set(processed_file_ids)
+    high_water_mark = None
+    for file_id in sorted(requested_file_ids):
+        if file_id not in processed_file_ids:
+            break
+        high_water_mark = int(file_id)
+    return high_water_mark
+
+
 @task(name='Test function which loads batch from test data')
 def load_image_batch(data: pd.DataFrame, size: int = 32):
     return data[data['processed'] == 0].iloc[:size]
@@ -177,6 +500,82 @@ def download_files(client: object, bucket_name: str, filenames: list, n_threads:
     print(f'Extracted {len(filenames)} files in {end} seconds')
 
 
+@task(name='Fetch files into memory for inference')
+def fetch_files(client: object, bucket_name: str, filenames: list, n_threads: int = 8, max_bytes: int = None) -> tuple:
+    """
+    Streams all files given by path into memory buffers. Nothing is written to the local filesystem.
+    Files which would exceed the memory budget are not fetched and returned as deferred. One file which
+    exceeds the whole budget on its own is fetched per call, else it would be deferred forever.
+
+    Parameters
+    ----------
+    client : object
+        Initiated minio client for s3 storage
+
+    bucket_name : str
+        name of the bucket
+
+    filenames : list
+        filenames to extract from bucket
+
+    n_threads : int, optional
+        number of threads to use for download, by default 8
+
+    max_bytes : int, optional
+        maximum number of bytes held in memory, by default None (unlimited)
+
+    Returns
+    -------
+    tuple
+        (dict object_name -> bytes, list of deferred object names)
+    """
+    buffers = {}
+    deferred = []
+    lock = threading.Lock()
+    used_bytes = [0]
+    # one file larger than max_bytes is admitted per call
+    oversize_admitted = [False]
+
+    def _fetch_file_mp(filename: str):
+        response = None
+        try:
+            response = client.get_object(
+                bucket_name=bucket_name,
+                object_name=filename
+            )
+            size = response.headers.get('Content-Length')
+            if size is None:
+                size = client.stat_object(bucket_name=bucket_name, object_name=filename).size
+            size = int(size)
+            # reserve memory budget before reading the object
+            with lock:
+                if max_bytes is not None and size > max_bytes and not oversize_admitted[0]:
+                    oversize_admitted[0] = True
+                    print(f'{filename} ({size / 1e6:.1f} MB) exceeds the memory budget, fetched anyway')
+                elif max_bytes is not None and used_bytes[0] + size > max_bytes:
+                    deferred.append(filename)
+                    return
+                used_bytes[0] += size
+            buffers[filename] = response.read()
+        except Exception as e:
+            print(e, f'Not worked for {filename}')
+        finally:
+            if response is not None:
+                response.close()
+                response.release_conn()
+
+    start = time.perf_counter()
+    with Pool(processes=n_threads) as pool:
+        pool.map(_fetch_file_mp, filenames)
+    end = time.perf_counter() - start
+
+    print(f'Fetched {len(buffers)} files ({used_bytes[0] / 1e6:.1f} MB) in {end} seconds')
+    if len(deferred) > 0:
+        print(f'Memory budget exceeded, deferred {len(deferred)} files to the next batch: {deferred}')
+
+    return buffers, deferred
+
+
 @task(
     name='Build FS mount path',
     description='Builds a list of paths which point to local filesystem mount.'
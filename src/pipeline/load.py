@@ -1,10 +1,10 @@
 import json
 import pandas as pd
 import numpy
-from tqdm import tqdm
 
 import psycopg2
 from psycopg2.extensions import register_adapter, AsIs
+from psycopg2.extras import execute_values
 
 from prefect import task
 
@@ -30,6 +30,8 @@ register_adapter(numpy.int64, addapt_numpy_int64)
 register_adapter(numpy.int32, addapt_numpy_int32)
 register_adapter(numpy.float32, addapt_numpy_float32)
 
+# rows per multi-row INSERT statement
+INSERT_PAGE_SIZE = 1000
 
 
 def is_model_config_up(conn: object, model_config: dict, db_schema: str = None) -> bool:
@@ -110,7 +112,11 @@ def db_insert_model_config(conn: object, model_config: dict, db_schema: str = No
 
 @task(name='Insert image_results')
 def db_insert_image_results(conn: object, data: pd.DataFrame, model_config: dict, allow_multiple_results: bool = True, db_schema: str = None):
-    """Adds processed data to image_results. Insert statement looks duplicated values during insertion.
+    """Adds processed data to image_results with multi-row inserts. Insert statement looks duplicated 
+    values during insertion.
+
+    The generated result_ids are returned in the order of the input rows, they are mapped back to the
+    rows by file_id (the order of RETURNING is not guaranteed).
 
     Parameters
     ----------
@@ -140,53 +146,46 @@ def db_insert_image_results(conn: object, data: pd.DataFrame, model_config: dict
     # Prpare data
     config_id = model_config['config_id']
     data['config_id'] = config_id
-    records = data[['file_id', 'config_id']].to_records(index=False)
+    records = [
+        (int(file_id), config_id) 
+        for file_id, config_id in data[['file_id', 'config_id']].to_records(index=False).tolist()
+    ]
 
-    results = []
     if not allow_multiple_results:    
-        try:    
-            with conn.cursor() as cursor:
-                for record in tqdm(records):  
-                    file_id = int(record[0])
-                    config_id = record[1]
-                    cursor.execute(
-                        """
-                        INSERT INTO {}image_results (file_id, config_id)
-                        SELECT %s, %s
-                        WHERE NOT EXISTS (
-                            SELECT file_id, config_id FROM {}image_results 
-                            WHERE file_id = %s AND config_id = %s
-                        )
-                        RETURNING result_id
-                        """.format(*db_schema),
-                        (file_id, config_id, file_id, config_id)
-                    )
-                    result = cursor.fetchone()[0]
-                    results.append(result)
-        except Exception:
-            raise Exception('Could not insert. Values might be written already to DB.')
-        finally:
-            conn.commit()
+        query = """
+            INSERT INTO {}image_results (file_id, config_id)
+            SELECT v.file_id, v.config_id FROM (VALUES %s) AS v (file_id, config_id)
+            WHERE NOT EXISTS (
+                SELECT file_id, config_id FROM {}image_results 
+                WHERE file_id = v.file_id AND config_id = v.config_id
+            )
+            RETURNING file_id, result_id
+            """.format(*db_schema)
     else:
-        try:    
-            with conn.cursor() as cursor:
-                for record in tqdm(records):  
-                    file_id = int(record[0])
-                    config_id = record[1]
-                    cursor.execute(
-                        """
-                        INSERT INTO {}image_results (file_id, config_id)
-                        VALUES (%s, %s)
-                        RETURNING result_id
-                        """.format(*db_schema),
-                        (file_id, config_id)
-                    )
-                    result = cursor.fetchone()[0]
-                    results.append(result)
-        except Exception:
-            raise Exception('Could not insert. Values might be written already to DB.')
-        finally:
-            conn.commit()
+        query = """
+            INSERT INTO {}image_results (file_id, config_id)
+            VALUES %s
+            RETURNING file_id, result_id
+            """.format(*db_schema)
+
+    try:    
+        with conn.cursor() as cursor:
+            results = execute_values(
+                cursor, query, records, page_size=INSERT_PAGE_SIZE, fetch=True
+            )
+        # skipped rows (existing results) do not return an id
+        if len(results) != len(records):
+            raise ValueError(f'Inserted {len(results)} of {len(records)} rows')
+        result_ids = dict(results)
+        if len(result_ids) != len(records):
+            raise ValueError('file_ids of the batch are not unique')
+        results = [result_ids[file_id] for file_id, _ in records]
+    except Exception:
+        # do not keep a partially inserted batch
+        conn.rollback()
+        raise Exception('Could not insert. Values might be written already to DB.')
+    finally:
+        conn.commit()
         
     return results
 
@@ -231,7 +230,9 @@ def db_get_image_results(conn: object, db_schema: str = None) -> pd.DataFrame:
 
 @task(name='Insert flower predictions into table flowers')
 def db_insert_flower_predictions(conn: object, data: pd.DataFrame, db_schema: str = None):
-    """Inserts flower predictions to flower table.
+    """Inserts flower predictions to flower table with multi-row inserts. The flower_ids are returned
+    in the order of the input rows, they are mapped back to the rows by result_id, class and box
+    (the order of RETURNING is not guaranteed).
 
     Parameters
     ----------
@@ -250,20 +251,28 @@ def db_insert_flower_predictions(conn: object, data: pd.DataFrame, db_schema: st
 
     records = data[[
         'result_id', 'flower_name', 'flower_score',
-        'x0', 'y0', 'x1', 'y1']].to_records(index=False)
-    flower_ids = []
+        'x0', 'y0', 'x1', 'y1']].to_records(index=False).tolist()
     try:    
         with conn.cursor() as cursor:
-            for record in tqdm(records):  
-                cursor.execute(
-                    """
-                    INSERT INTO {}flowers (result_id, class, confidence, x0, y0, x1, y1)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s)
-                    RETURNING flower_id
-                    """.format(*db_schema),
-                    record
-                )
-                flower_ids.append(cursor.fetchone()[0])
+            flower_ids = execute_values(
+                cursor,
+                """
+                INSERT INTO {}flowers (result_id, class, confidence, x0, y0, x1, y1)
+                VALUES %s
+                RETURNING result_id, class, x0, y0, x1, y1, flower_id
+                """.format(*db_schema),
+                records,
+                page_size=INSERT_PAGE_SIZE,
+                fetch=True
+            )
+        # rows with equal keys are identical boxes of one image, their ids are interchangeable
+        ids_by_key = {}
+        for row in flower_ids:
+            ids_by_key.setdefault(tuple(row[:-1]), []).append(row[-1])
+        flower_ids = [
+            ids_by_key[(result_id, name, x0, y0, x1, y1)].pop()
+            for result_id, name, _, x0, y0, x1, y1 in records
+        ]
     except Exception:
         raise Exception('Could not insert.')
     finally:
@@ -273,7 +282,7 @@ def db_insert_flower_predictions(conn: object, data: pd.DataFrame, db_schema: st
 
 @task(name='Insert pollinator predictions into table pollinators')
 def db_insert_pollinator_predictions(conn: object, data: pd.DataFrame, db_schema: str = None):
-    """Inserts data for pollinator predictions
+    """Inserts data for pollinator predictions with multi-row inserts
 
     Parameters
     ----------
@@ -291,18 +300,124 @@ def db_insert_pollinator_predictions(conn: object, data: pd.DataFrame, db_schema
     records = data[[
         'result_id', 'flower_id', 
         'pollinator_names', 'pollinator_scores',
-        'x0', 'y0', 'x1', 'y1']].to_records(index=False)
+        'x0', 'y0', 'x1', 'y1']].to_records(index=False).tolist()
     try:    
         with conn.cursor() as cursor:
-            for record in tqdm(records):  
-                cursor.execute(
-                    """
-                    INSERT INTO {}pollinators (result_id, flower_id, class, confidence, x0, y0, x1, y1)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                    """.format(*db_schema),
-                    record
-                )
+            execute_values(
+                cursor,
+                """
+                INSERT INTO {}pollinators (result_id, flower_id, class, confidence, x0, y0, x1, y1)
+                VALUES %s
+                """.format(*db_schema),
+                records,
+                page_size=INSERT_PAGE_SIZE
+            )
     except Exception:
         raise Exception('Could not insert.')
     finally:
-        conn.commit()
\ No newline at end of file
+        conn.commit()
+
+
+@task(name='Update checkpoint high-water mark')
+def db_update_checkpoint(conn: object, model_config_id: str, last_file_id: int, db_schema: str = None,
+                         verify: bool = False):
+    """Persists the high-water mark of a model configuration: all files up to last_file_id are processed.
+    The high-water mark never moves backwards.
+
+    Parameters
+    ----------
+    conn : object
+        psycopg2 db connection object
+
+    model_config_id : str
+        model configuration ID
+
+    last_file_id : int
+        highest file_id up to which all files were processed
+
+    db_schema: str, optional
+        defines the database schema to use, default None
+
+    verify : bool, optional
+        if True the high-water mark stops before the first unprocessed file after the current
+        high-water mark, e.g. files still claimed by concurrent workers, by default False
+    """
+    db_schema = edit_schema(db_schema=db_schema, n=4)
+
+    if verify:
+        new_file_id = """
+            LEAST(%(last_file_id)s, COALESCE((
+                SELECT min(f.file_id) - 1 FROM {}files_image AS f
+                WHERE f.file_id <= %(last_file_id)s
+                AND f.file_id > COALESCE((
+                    SELECT last_file_id FROM {}pollinator_checkpoints
+                    WHERE config_id = %(config_id)s
+                ), 0)
+                AND NOT EXISTS (
+                    SELECT 1 FROM {}image_results AS r
+                    WHERE r.config_id = %(config_id)s AND r.file_id = f.file_id
+                )
+            ), %(last_file_id)s))
+            """.format(db_schema[1], db_schema[2], db_schema[3])
+    else:
+        new_file_id = '%(last_file_id)s'
+
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                INSERT INTO {}pollinator_checkpoints AS c (config_id, last_file_id, updated_at)
+                VALUES (%(config_id)s, {}, now())
+                ON CONFLICT (config_id) DO UPDATE
+                SET last_file_id = GREATEST(c.last_file_id, EXCLUDED.last_file_id), updated_at = now()
+                """.format(db_schema[0], new_file_id),
+                {'config_id': model_config_id, 'last_file_id': last_file_id}
+            )
+    except Exception:
+        raise Exception('Could not update checkpoint.')
+    finally:
+        conn.commit()
+
+
+@task(name='Release claimed files')
+def db_release_claims(conn: object, model_config_id: str, worker_id: str, file_ids: list = None, db_schema: str = None):
+    """Removes the claims of worker_id on the given files (see claim_checkpoint). Files which were not
+    processed can be claimed again right away.
+
+    Parameters
+    ----------
+    conn : object
+        psycopg2 db connection object
+
+    model_config_id : str
+        model configuration ID
+
+    worker_id : str
+        ID of the worker which claimed the files
+
+    file_ids : list, optional
+        claimed file_ids, by default None (all claims of worker_id)
+
+    db_schema: str, optional
+        defines the database schema to use, default None
+    """
+    db_schema = edit_schema(db_schema=db_schema, n=1)
+
+    file_filter = 'AND file_id = ANY(%s)' if file_ids is not None else ''
+    params = (model_config_id, worker_id)
+    if file_ids is not None:
+        params += ([int(file_id) for file_id in file_ids],)
+
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                DELETE FROM {}pollinator_file_claims
+                WHERE config_id = %s AND worker_id = %s {}
+                """.format(db_schema[0], file_filter),
+                params
+            )
+    except Exception:
+        raise Exception('Could not release claims.')
+    finally:
+        conn.commit()
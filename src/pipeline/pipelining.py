@@ -0,0 +1,92 @@
+import queue
+import threading
+
+
+# marks the end of the item stream
+_STOP = object()
+
+
+def run_pipelined(items: list, stages: list, max_queue_size: int = 2) -> list:
+    """
+    Runs every item through a chain of stages. Each stage runs in its own thread
+    and the stages are connected with bounded queues, so stage k works on item N
+    while stage k+1 works on item N-1. A stage blocks as soon as the queue to the
+    next stage is full (backpressure).
+
+    Stages run outside of the prefect flow context, use the underlying function
+    of a task (task.fn) within a stage.
+
+    Parameters
+    ----------
+    items : list
+        inputs of the first stage
+
+    stages : list
+        callables, each one gets the output of the previous stage as argument
+
+    max_queue_size : int, optional
+        maximum number of items waiting in front of each stage, by default 2
+
+    Returns
+    -------
+    list
+        outputs of the last stage in the order of the items
+
+    Raises
+    ------
+    Exception
+        the first exception raised by any stage, after all stages have stopped
+    """
+    queues = [queue.Queue(maxsize=max_queue_size) for _ in range(len(stages) + 1)]
+    errors = []
+    results = []
+
+    def _run_stage(stage, inbox, outbox):
+        while True:
+            item = inbox.get()
+            if item is _STOP:
+                outbox.put(_STOP)
+                return
+            # after a failure the remaining items are drained only
+            if len(errors) > 0:
+                continue
+            try:
+                outbox.put(stage(item))
+            except Exception as e:
+                errors.append(e)
+
+    def _collect(inbox):
+        while True:
+            item = inbox.get()
+            if item is _STOP:
+                return
+            results.append(item)
+
+    threads = [
+        threading.Thread(
+            target=_run_stage,
+            args=(stage, queues[i], queues[i + 1]),
+            name=f'pipeline-stage-{i}',
+            daemon=True
+        )
+        for i, stage in enumerate(stages)
+    ]
+    threads.append(
+        threading.Thread(target=_collect, args=(queues[-1],), name='pipeline-collect', daemon=True)
+    )
+    for thread in threads:
+        thread.start()
+
+    for item in items:
+        if len(errors) > 0:
+            break
+        queues[0].put(item)
+    queues[0].put(_STOP)
+
+    for thread in threads:
+        thread.join()
+
+    if len(errors) > 0:
+        raise errors[0]
+
+    return results
@@ -1,7 +1,11 @@
 import os
 import shutil
 import yaml
+from io import BytesIO
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 import pandas as pd
 from PIL import Image
 import PIL
@@ -10,16 +14,89 @@ from tqdm import tqdm
 from prefect import task
 
 if __name__ =='__main__':
-    from Pollinatordetection import YoloModel
+    from Pollinatordetection import load_model, CropCollector, DraftImage
 else:    
-    from .Pollinatordetection import YoloModel
+    from .Pollinatordetection import load_model, CropCollector, DraftImage
     
 
+# Column-wise model outputs: name -> (dtype, shape of one row)
+# image_row is the row of the image in the checkpoint dataframe
+FLOWER_COLUMNS = {
+    'image_row': (np.int64, ()),
+    'flower_box_id': (np.int64, ()),
+    'flower_box': (np.float32, (4,)),
+    'flower_class': (np.int64, ()),
+    'flower_score': (np.float32, ()),
+    'flower_name': (object, ()),
+    'width': (np.int64, ()),
+    'height': (np.int64, ()),
+}
+# flower_row is the row of the flower in the flower predictions
+POLLINATOR_COLUMNS = {
+    'flower_row': (np.int64, ()),
+    'pollinator_boxes': (np.float32, (4,)),
+    'pollinator_classes': (np.int64, ()),
+    'pollinator_scores': (np.float32, ()),
+    'pollinator_names': (object, ()),
+}
+
+
+def concat_columns(parts: list, columns: dict) -> dict:
+    """
+    Concatenates column-wise predictions.
+
+    Parameters
+    ----------
+    parts : list
+        dicts of column name -> array (or list of arrays per column)
+
+    columns : dict
+        FLOWER_COLUMNS or POLLINATOR_COLUMNS
+
+    Returns
+    -------
+    dict
+        column name -> array, empty arrays of the right shape if there are no rows
+    """
+    result = {}
+    for name, (dtype, shape) in columns.items():
+        arrays = []
+        for part in parts:
+            if isinstance(part[name], list):
+                arrays += part[name]
+            else:
+                arrays.append(part[name])
+        if len(arrays) > 0:
+            result[name] = np.concatenate(arrays).astype(dtype, copy=False)
+        else:
+            result[name] = np.zeros((0, *shape), dtype=dtype)
+    return result
+
+
+def n_rows(predictions: dict) -> int:
+    """
+    Returns the number of rows of column-wise predictions.
+    """
+    return len(next(iter(predictions.values())))
+
+
 @task
 def dummy_transform(remove_dir):
     shutil.rmtree(path=remove_dir, ignore_errors=True)
 
-def init_models(cfg: dict):
+def init_models(cfg: dict, yolov5_path: str = None):
+    """
+    Returns the flower and pollinator model for the given model configuration.
+    Models are loaded once per process and reused by subsequent calls.
+
+    Parameters
+    ----------
+    cfg : dict
+        model configuration (model_config.json)
+
+    yolov5_path : str, optional
+        local yolov5 repository to load the models offline, by default None
+    """
     # Flower Model configuration
     model_flower_config = cfg.get("flower")
     MODEL_FLOWER_WEIGHTS = model_flower_config.get("weights_path")
@@ -34,11 +111,13 @@ def init_models(cfg: dict):
     MODEL_FLOWER_MAX_DETECTIONS = model_flower_config.get("max_detections")
     MODEL_FLOWER_AUGMENT = model_flower_config.get("augment", False)
     MODEL_FLOWER_IMG_SIZE = model_flower_config.get("image_size")
+    MODEL_FLOWER_BATCH_SIZE = model_flower_config.get("batch_size", 16)
 
     model_pollinator_config = cfg.get("pollinator")
     MODEL_POLLINATOR_WEIGHTS = model_pollinator_config.get("weights_path")
     MODEL_POLLINATOR_CLASS_NAMES = model_pollinator_config.get("class_names")
     MODEL_POLLINATOR_IMG_SIZE = model_pollinator_config.get("image_size")
+    MODEL_POLLINATOR_BATCH_SIZE = model_pollinator_config.get("batch_size", 16)
     MODEL_POLLINATOR_CONFIDENCE_THRESHOLD = model_pollinator_config.get(
         "confidence_threshold"
     )
@@ -51,8 +130,9 @@ def init_models(cfg: dict):
         "multi_label_iou_threshold"
     )
     # Init Flower Model
-    flower_model = YoloModel(
+    flower_model = load_model(
         MODEL_FLOWER_WEIGHTS,
+        yolov5_path=yolov5_path,
         image_size=MODEL_FLOWER_IMG_SIZE,
         confidence_threshold=MODEL_FLOWER_CONFIDENCE_THRESHOLD,
         iou_threshold=MODEL_FLOWER_IOU_THRESHOLD,
@@ -62,11 +142,13 @@ def init_models(cfg: dict):
         multi_label_iou_threshold=MODEL_FLOWER_MULTI_LABEL_IOU_THRESHOLD,
         augment=MODEL_FLOWER_AUGMENT,
         max_det=MODEL_FLOWER_MAX_DETECTIONS,
+        batch_size=MODEL_FLOWER_BATCH_SIZE,
     )
 
     # Init Pollinator Model
-    pollinator_model = YoloModel(
+    pollinator_model = load_model(
         MODEL_POLLINATOR_WEIGHTS,
+        yolov5_path=yolov5_path,
         image_size=MODEL_POLLINATOR_IMG_SIZE,
         confidence_threshold=MODEL_POLLINATOR_CONFIDENCE_THRESHOLD,
         iou_threshold=MODEL_POLLINATOR_IOU_THRESHOLD,
@@ -76,99 +158,216 @@ def init_models(cfg: dict):
         multi_label_iou_threshold=MODEL_POLLINATOR_MULTI_LABEL_IOU_THRESHOLD,
         augment=MODEL_POLLINATOR_AUGMENT,
         max_det=MODEL_POLLINATOR_MAX_DETECTIONS,
+        batch_size=MODEL_POLLINATOR_BATCH_SIZE,
     )
 
     return flower_model, pollinator_model
 
 
-@task(name='Model inference')
-def model_predict(data: pd.DataFrame, cfg: dict): 
+def iter_decoded_images(filenames: list, decode: callable, n_workers: int = 4, prefetch: int = 8):
+    """
+    Decodes images in a thread pool ahead of the consumer. At most prefetch images are
+    decoded or waiting at a time, so the decoded images are held in a bounded buffer
+    while the current batch is in the model. JPEG decoding releases the GIL.
 
-    flower_model, pollinator_model = init_models(cfg=cfg) 
+    Parameters
+    ----------
+    filenames : list
+        files to decode, in order
 
-    # Initiate
-    flower_predictions, pollinator_predictions = [], []
+    decode : callable
+        decodes one file, gets the filename as argument
 
-    with tqdm(total=len(data)) as pbar:
+    n_workers : int, optional
+        decoding threads, by default 4
 
-        for idx in data.index:
-            filename = data.loc[idx, 'object_name']
-            pbar.set_description(f'Processing File {filename}')
+    prefetch : int, optional
+        maximum number of images decoded ahead, by default 8
 
-            flower_model.reset_inference_times()
-            pollinator_model.reset_inference_times()
-            # predict flower
+    Yields
+    ------
+    tuple
+        (filename, image, error) in the order of filenames. image is None and error is the
+        raised exception if the file could not be decoded.
+    """
+    pending = deque()
+    remaining = iter(filenames)
+    executor = ThreadPoolExecutor(max_workers=n_workers, thread_name_prefix='decode')
+    try:
+        for filename in remaining:
+            pending.append((filename, executor.submit(decode, filename)))
+            if len(pending) >= prefetch:
+                break
+        while len(pending) > 0:
+            filename, future = pending.popleft()
+            # keep the pool busy while the consumer works on this image
+            for next_filename in remaining:
+                pending.append((next_filename, executor.submit(decode, next_filename)))
+                break
             try:
-                img = Image.open(filename)
-                original_width, original_height = img.size
+                yield filename, future.result(), None
             except Exception as e:
-                print(e(f'Not able to load image {filename}'))
-                pbar.update(1)
+                yield filename, None, e
+    finally:
+        for _, future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+@task(name='Model inference')
+def model_predict(
+    data: pd.DataFrame,
+    cfg: dict,
+    yolov5_path: str = None,
+    buffers: dict = None,
+    n_decode_workers: int = 4
+): 
+    """
+    Runs flower and pollinator inference on all images of the checkpoint dataframe.
+
+    Parameters
+    ----------
+    data : pd.DataFrame
+        checkpoint dataframe, column object_name holds the image paths
+
+    cfg : dict
+        model configuration
+
+    yolov5_path : str, optional
+        local yolov5 repository to load the models offline, by default None
+
+    buffers : dict, optional
+        object_name -> encoded image bytes (see fetch_files). If given, images are decoded
+        from memory instead of being read from the filesystem. Decoded buffers are removed
+        from the dict to release memory early, by default None
+
+    n_decode_workers : int, optional
+        threads decoding the next images while a batch is in the model, by default 4
+
+    Returns
+    -------
+    tuple
+        flower_predictions, pollinator_predictions as dicts of arrays (FLOWER_COLUMNS,
+        POLLINATOR_COLUMNS)
+    """
+
+    flower_model, pollinator_model = init_models(cfg=cfg, yolov5_path=yolov5_path) 
+    # decode JPEGs at reduced resolution, full resolution only for the crops
+    draft_decode = cfg.get('flower').get('draft_decode', False)
+
+    # Initiate, predictions are collected column-wise as lists of arrays
+    flower_parts = {name: [] for name in FLOWER_COLUMNS}
+    pollinator_parts = {name: [] for name in POLLINATOR_COLUMNS}
+    n_flowers = 0
+    filenames = data['object_name'].to_list()
+
+    def _decode(image_row):
+        filename = filenames[image_row]
+        source = buffers.pop(filename) if buffers is not None else filename
+        if draft_decode:
+            return DraftImage(source, flower_model.image_size)
+        img = Image.open(BytesIO(source) if buffers is not None else source)
+        img.load()
+        return img
+
+    def _predict_batch(image_rows, images):
+        nonlocal n_flowers
+        batch_filenames = [filenames[image_row] for image_row in image_rows]
+        flower_model.reset_inference_times()
+        pollinator_model.reset_inference_times()
+        # predict flower
+        try:
+            flower_model.predict_batch(images)
+        except Exception as e:
+            print(e, f'Could not do inference for {batch_filenames}')
+            return
+
+        # collect the flower crops of all images in the batch
+        crop_collector = CropCollector()
+        for image_index, image_row in enumerate(image_rows):
+            flower_crops = flower_model.get_crops(image_index)
+            if draft_decode:
+                # only the reduced image is kept for the rest of the batch
+                images[image_index].release()
+            n = len(flower_crops)
+            if n == 0:
                 continue
-            try:
-                flower_model.predict(img)
-            except Exception as e:
-                print(e(f'Could not do inference for {filename}'))
+            flower_parts['image_row'].append(np.full(n, image_row))
+            flower_parts['flower_box_id'].append(np.arange(n))
+            flower_parts['flower_box'].append(flower_model.get_boxes(image_index))
+            flower_parts['flower_class'].append(flower_model.get_classes(image_index))
+            flower_parts['flower_score'].append(flower_model.get_scores(image_index))
+            flower_parts['flower_name'].append(flower_model.get_names(image_index))
+            flower_parts['width'].append(np.array([crop.shape[1] for crop in flower_crops]))
+            flower_parts['height'].append(np.array([crop.shape[0] for crop in flower_crops]))
+            for flower_index, crop in enumerate(flower_crops):
+                crop_collector.add(n_flowers + flower_index, crop)
+            n_flowers += n
+
+        # predict pollinator on all flower crops of the batch at once
+        try:
+            crop_indexes = crop_collector.predict(pollinator_model)
+        except Exception as e:
+            print(e, f'Could not do pollinator inference for {batch_filenames}')
+            crop_indexes = {}
+
+        for flower_row, crop_index in crop_indexes.items():
+            pollinator_boxes = pollinator_model.get_boxes(crop_index)
+            if len(pollinator_boxes) > 0: 
+                pollinator_parts['flower_row'].append(np.full(len(pollinator_boxes), flower_row))
+                pollinator_parts['pollinator_boxes'].append(pollinator_boxes)
+                pollinator_parts['pollinator_classes'].append(pollinator_model.get_classes(crop_index))
+                pollinator_parts['pollinator_scores'].append(pollinator_model.get_scores(crop_index))
+                pollinator_parts['pollinator_names'].append(pollinator_model.get_names(crop_index))
+
+    with tqdm(total=len(data)) as pbar:
+        # the next batch is decoded while the current one is in the model
+        decoded = iter_decoded_images(
+            list(range(len(filenames))),
+            _decode,
+            n_workers=n_decode_workers,
+            prefetch=2 * flower_model.batch_size
+        )
+        image_rows, images = [], []
+        for image_row, img, error in decoded:
+            filename = filenames[image_row]
+            pbar.set_description(f'Processing File {filename}')
+            if error is not None:
+                # a corrupt file must not fail the whole batch
+                print(error, f'Not able to load image {filename}')
                 pbar.update(1)
-                continue
-            
-            flower_crops = flower_model.get_crops()
-            flower_boxes = flower_model.get_boxes()
-            flower_classes = flower_model.get_classes()
-            flower_scores = flower_model.get_scores()
-            flower_names = flower_model.get_names()
-
-            for flower_index in range(len(flower_crops)):
-                width, height = (
-                    flower_crops[flower_index].shape[1],
-                    flower_crops[flower_index].shape[0],
-                )
-
-                # write flower predictions dataframe
-                flower_predictions.append(
-                    {
-                        'object_name': filename,
-                        'flower_box_id': flower_index,
-                        'flower_box': flower_boxes[flower_index], 
-                        'flower_class': flower_classes[flower_index], 
-                        'flower_score': flower_scores[flower_index], 
-                        'flower_name': flower_names[flower_index],
-                        'width': width,
-                        'height': height
-                    }
-                )
-                # predict pollinator
-                pollinator_model.predict(flower_crops[flower_index])
-
-                if len(pollinator_model.get_boxes()) > 0: 
-                    for i in range(len(pollinator_model.get_boxes())):
-                        pollinator_predictions.append(
-                            {
-                                'object_name': filename,
-                                'flower_box_id': flower_index,
-                                'pollinator_boxes' : pollinator_model.get_boxes()[i],
-                                'pollinator_classes' : pollinator_model.get_classes()[i],
-                                'pollinator_scores' : pollinator_model.get_scores()[i],
-                                'pollinator_names' : pollinator_model.get_names()[i],
-                            }
-                        )
-                        
-            pbar.update(1)
+            else:
+                image_rows.append(image_row)
+                images.append(img)
+
+            # flower inference runs on micro-batches of batch_size rows, failed
+            # files leave a gap, so the batches only depend on the row positions
+            if (image_row + 1) % flower_model.batch_size == 0 and len(images) > 0:
+                _predict_batch(image_rows, images)
+                pbar.update(len(image_rows))
+                image_rows, images = [], []
+
+        if len(images) > 0:
+            _predict_batch(image_rows, images)
+            pbar.update(len(image_rows))
+
+    flower_predictions = concat_columns([flower_parts], FLOWER_COLUMNS)
+    pollinator_predictions = concat_columns([pollinator_parts], POLLINATOR_COLUMNS)
 
     return flower_predictions, pollinator_predictions            
 
 @task(name='Process flower predictions')
 def process_flower_predictions(flower_predictions: dict, result_ids: pd.DataFrame, model_config: float) -> pd.DataFrame:
     """
-    Post-processing of flower predictions outputet as json. 
+    Post-processing of the column-wise flower predictions.
 
     Parameters
     ----------
-    flower_predictions : dict (json)
-        Predictions from Yolo for a certain flower.
+    flower_predictions : dict
+        Predictions from Yolo for a certain flower (FLOWER_COLUMNS).
 
     result_ids : pd.DataFrame
-        Queried data with existing result_ids
+        Queried data with existing result_ids, in the row order model_predict ran on
     
     model_config: dict
         Relevant margin which was used to crop the flower for further
@@ -179,27 +378,17 @@ def process_flower_predictions(flower_predictions: dict, result_ids: pd.DataFram
     pd.DataFrame
         processed dataframe ready for db insertion
     """
-    box_margin = model_config['flower']['margin']
-    # Preprocess results from model_predict
-    flower_predictions = pd.DataFrame.from_records(flower_predictions)
-    
-    # Join with DB data
-    flower_predictions = pd.merge(
-        left=result_ids, 
-        right=flower_predictions, 
-        left_on='object_name', 
-        right_on='object_name', 
-        how='right'
-    )
-    # extract bbox data
-    flower_predictions['x0'] = flower_predictions['flower_box'].apply(lambda x: x[0]).astype(int)
-    flower_predictions['y0'] = flower_predictions['flower_box'].apply(lambda x: x[1]).astype(int)
-    flower_predictions['x1'] = flower_predictions['flower_box'].apply(lambda x: x[2]).astype(int)
-    flower_predictions['y1'] = flower_predictions['flower_box'].apply(lambda x: x[3]).astype(int)
-    
-    flower_predictions = flower_predictions.drop('flower_box', axis=1)
+    # Join with DB data by row position of the image
+    processed = result_ids.iloc[flower_predictions['image_row']].reset_index(drop=True)
+    for name in ['flower_box_id', 'flower_class', 'flower_score', 'flower_name', 'width', 'height']:
+        processed[name] = flower_predictions[name]
 
-    return flower_predictions
+    # extract bbox data, truncated to int pixels
+    boxes = flower_predictions['flower_box'].astype(int)
+    for i, name in enumerate(['x0', 'y0', 'x1', 'y1']):
+        processed[name] = boxes[:, i]
+
+    return processed
 
 @task(name='Process pollinator predictions')
 def process_pollinator_predictions(pollinator_predictions: dict, flower_predictions: pd.DataFrame, model_config: dict = None) -> pd.DataFrame:
@@ -210,10 +399,11 @@ def process_pollinator_predictions(pollinator_predictions: dict, flower_predicti
     Parameters
     ----------
     pollinator_predictions : dict
-        Modell output pollinator predictions
+        Modell output pollinator predictions (POLLINATOR_COLUMNS)
 
     flower_predictions : pd.DataFrame
-        Pre-processed flower predictions model output
+        Pre-processed flower predictions model output with flower_id, in the row order of
+        process_flower_predictions
 
     model_config: dict
         Relevant margin which was used to crop the flower for further
@@ -228,47 +418,22 @@ def process_pollinator_predictions(pollinator_predictions: dict, flower_predicti
     # add box margin relative to width/heigth, which ensures the correct bbox for all 
     # pollinators as they are relative to the flower bbox + margin
     box_margin = model_config['flower']['margin']
-    flower_predictions['x0'] = flower_predictions['x0'] - box_margin
-    flower_predictions['y0'] = flower_predictions['y0'] - box_margin
-    flower_predictions['x1'] = flower_predictions['x1'] + box_margin
-    flower_predictions['y1'] = flower_predictions['y1'] + box_margin
-
-    pollinator_predictions = pd.DataFrame.from_records(pollinator_predictions)
-
-    # Join with DB data
-    # Merge with flowers to get size of BB
-    pollinator_predictions = pd.merge(
-        left=pollinator_predictions, 
-        right=flower_predictions[['object_name', 'flower_box_id', 'result_id', 'flower_id', 'x0', 'y0', 'x1', 'y1']], 
-        left_on=['object_name', 'flower_box_id'], right_on=['object_name', 'flower_box_id'], 
-        how='inner'
-    )
-    # rename columns
-    pollinator_predictions = pollinator_predictions.rename(
-        columns={
-            'x0': 'f_x0', 'x1': 'f_x1',
-            'y0': 'f_y0', 'y1': 'f_y1'
-        }
-    )
-    # Calculate BBoxes given previous flower perdiction
-    pollinator_predictions['p_x0'] = pollinator_predictions['pollinator_boxes'].apply(lambda x: x[0]).astype(int)
-    pollinator_predictions['p_y0'] = pollinator_predictions['pollinator_boxes'].apply(lambda x: x[1]).astype(int)
-    pollinator_predictions['p_x1'] = pollinator_predictions['pollinator_boxes'].apply(lambda x: x[2]).astype(int)
-    pollinator_predictions['p_y1'] = pollinator_predictions['pollinator_boxes'].apply(lambda x: x[3]).astype(int)
-
+    flower_rows = pollinator_predictions['flower_row']
+
+    # Join with flowers by row position
+    flowers = flower_predictions[['object_name', 'flower_box_id', 'result_id', 'flower_id']].iloc[flower_rows]
+    processed = flowers[['object_name', 'flower_box_id']].reset_index(drop=True)
+    processed['pollinator_scores'] = pollinator_predictions['pollinator_scores']
+    processed['pollinator_names'] = pollinator_predictions['pollinator_names']
+    processed['result_id'] = flowers['result_id'].to_numpy()
+    processed['flower_id'] = flowers['flower_id'].to_numpy()
+
+    # top left corner of the crop the pollinator box is relative to
+    crop_origin = flower_predictions[['x0', 'y0']].to_numpy()[flower_rows] - box_margin
     # new_xmin = flower_xmin + polli_xmin / new_ymin = flower_ymin + polli_ymin
-    pollinator_predictions['x0'] = pollinator_predictions['f_x0'] + pollinator_predictions['p_x0']
-    pollinator_predictions['y0'] = pollinator_predictions['f_y0'] + pollinator_predictions['p_y0']
     # new_xmax = flower_xmin + polli_xmax / new_ymax = flower_xmin + polli_ymax
-    pollinator_predictions['x1'] = pollinator_predictions['f_x0'] + pollinator_predictions['p_x1']
-    pollinator_predictions['y1'] = pollinator_predictions['f_y0'] + pollinator_predictions['p_y1']
-
-    pollinator_predictions = pollinator_predictions.drop(
-        [
-            'p_x0', 'p_x1', 'p_y0', 'p_y1', 'f_x0', 'f_x1', 'f_y0',
-            'f_y1', 'pollinator_boxes', 'pollinator_classes'
-        ], 
-        axis=1
-    )
+    boxes = pollinator_predictions['pollinator_boxes'].astype(int) + np.tile(crop_origin, 2)
+    for i, name in enumerate(['x0', 'y0', 'x1', 'y1']):
+        processed[name] = boxes[:, i]
 
-    return pollinator_predictions
\ No newline at end of file
+    return processed
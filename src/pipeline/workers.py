@@ -0,0 +1,202 @@
+import json
+import math
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import pandas as pd
+import torch
+
+from prefect import task
+
+from .transform import (
+    FLOWER_COLUMNS,
+    POLLINATOR_COLUMNS,
+    concat_columns,
+    init_models,
+    model_predict,
+)
+
+
+# process-level worker pools, see get_worker_pool
+_WORKER_POOLS = {}
+_WORKER_POOLS_LOCK = threading.Lock()
+
+
+def _init_worker(cfg: dict, yolov5_path: str, torch_threads: int):
+    """Pins the torch intra-op threads of the worker and loads its models once."""
+    torch.set_num_threads(torch_threads)
+    init_models(cfg=cfg, yolov5_path=yolov5_path)
+
+
+def _predict_shard(data: pd.DataFrame, cfg: dict, yolov5_path: str, buffers: dict, n_decode_workers: int) -> tuple:
+    """Runs model_predict on one shard within a worker process."""
+    return model_predict.fn(
+        data=data,
+        cfg=cfg,
+        yolov5_path=yolov5_path,
+        buffers=buffers,
+        n_decode_workers=n_decode_workers
+    )
+
+
+def get_worker_pool(n_workers: int, cfg: dict, yolov5_path: str = None, torch_threads: int = None) -> ProcessPoolExecutor:
+    """
+    Returns a pool of inference worker processes, each one holds its own flower and pollinator
+    model. Pools are created once per process and configuration and reused by subsequent calls.
+
+    Parameters
+    ----------
+    n_workers : int
+        number of worker processes
+
+    cfg : dict
+        model configuration
+
+    yolov5_path : str, optional
+        local yolov5 repository to load the models offline, by default None
+
+    torch_threads : int, optional
+        torch intra-op threads per worker, by default the CPU cores divided by n_workers
+
+    Returns
+    -------
+    ProcessPoolExecutor
+    """
+    if torch_threads is None:
+        torch_threads = max(1, (os.cpu_count() or 1) // n_workers)
+    key = (n_workers, json.dumps(cfg, sort_keys=True), yolov5_path, torch_threads)
+    with _WORKER_POOLS_LOCK:
+        pool = _WORKER_POOLS.get(key)
+        if pool is None:
+            # spawn, torch must not be forked after its thread pools were initialized
+            pool = ProcessPoolExecutor(
+                max_workers=n_workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker,
+                initargs=(cfg, yolov5_path, torch_threads)
+            )
+            _WORKER_POOLS[key] = pool
+
+    return pool
+
+
+def discard_worker_pool(pool: ProcessPoolExecutor):
+    """
+    Removes a pool from the cache of get_worker_pool and shuts it down, e.g. after a worker died.
+    The next call of get_worker_pool creates a new pool.
+    """
+    with _WORKER_POOLS_LOCK:
+        for key, cached_pool in list(_WORKER_POOLS.items()):
+            if cached_pool is pool:
+                del _WORKER_POOLS[key]
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def split_shards(n_rows: int, n_shards: int, align: int) -> list:
+    """
+    Splits n_rows into at most n_shards contiguous ranges whose sizes are multiples of align
+    (except for the last one).
+
+    Returns
+    -------
+    list
+        [(start, end), ...]
+    """
+    n_blocks = math.ceil(n_rows / align)
+    shard_size = math.ceil(n_blocks / max(n_shards, 1)) * align
+    return [
+        (start, min(start + shard_size, n_rows))
+        for start in range(0, n_rows, max(shard_size, 1))
+    ]
+
+
+@task(name='Model inference (worker pool)')
+def model_predict_parallel(
+    data: pd.DataFrame,
+    cfg: dict,
+    n_workers: int,
+    yolov5_path: str = None,
+    buffers: dict = None,
+    torch_threads: int = None,
+    n_decode_workers: int = 4
+) -> tuple:
+    """
+    Runs model_predict on shards of the checkpoint dataframe in a pool of worker processes.
+    Shards are aligned to the flower batch size, so every image is in the same micro-batch as
+    in the serial path and the results are identical to model_predict. If a worker dies (e.g.
+    killed for running out of memory) the pool is recreated and the batch retried once.
+
+    Parameters
+    ----------
+    data : pd.DataFrame
+        checkpoint dataframe, column object_name holds the image paths
+
+    cfg : dict
+        model configuration
+
+    n_workers : int
+        number of worker processes
+
+    yolov5_path : str, optional
+        local yolov5 repository to load the models offline, by default None
+
+    buffers : dict, optional
+        object_name -> encoded image bytes (see fetch_files), by default None
+
+    torch_threads : int, optional
+        torch intra-op threads per worker, by default the CPU cores divided by n_workers
+
+    n_decode_workers : int, optional
+        decoding threads per worker, by default 4
+
+    Returns
+    -------
+    tuple
+        flower_predictions, pollinator_predictions as dicts of arrays, rows refer to data
+    """
+    batch_size = cfg.get('flower').get('batch_size', 16)
+
+    shards = []
+    for start, end in split_shards(data.shape[0], n_workers, batch_size):
+        shard = data.iloc[start:end].reset_index(drop=True)
+        shard_buffers = None
+        if buffers is not None:
+            shard_buffers = {
+                filename: buffers.pop(filename)
+                for filename in shard['object_name'] if filename in buffers
+            }
+        shards.append((start, shard, shard_buffers))
+
+    for attempt in range(2):
+        pool = get_worker_pool(n_workers, cfg, yolov5_path, torch_threads)
+        try:
+            results = [
+                (start, pool.submit(_predict_shard, shard, cfg, yolov5_path, shard_buffers, n_decode_workers))
+                for start, shard, shard_buffers in shards
+            ]
+            results = [(start, future.result()) for start, future in results]
+            break
+        except BrokenProcessPool:
+            # a worker died, all later batches would fail with this pool
+            discard_worker_pool(pool)
+            if attempt > 0:
+                raise
+            print('Inference worker pool broken, recreating it and retrying the batch')
+
+    # concat in shard order, rows are shifted from shard to data positions
+    flower_parts, pollinator_parts = [], []
+    n_flowers = 0
+    for start, (flowers, pollinators) in results:
+        flowers['image_row'] = flowers['image_row'] + start
+        pollinators['flower_row'] = pollinators['flower_row'] + n_flowers
+        n_flowers += len(flowers['image_row'])
+        flower_parts.append(flowers)
+        pollinator_parts.append(pollinators)
+
+    return (
+        concat_columns(flower_parts, FLOWER_COLUMNS),
+        concat_columns(pollinator_parts, POLLINATOR_COLUMNS)
+    )
@@ -0,0 +1,38 @@
+import json
+import os
+import sys
+
+import pytest
+
+Image = pytest.importorskip("PIL.Image")
+pytest.importorskip("requests")
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "src", "pipeline", "Pollinatordetection")
+)
+from messagehelper import Flower, MessageGenerator, Pollinator  # noqa: E402
+
+
+def _message_generator(n_flowers, n_pollinators):
+    message_generator = MessageGenerator()
+    message_generator.set_filename("0344-6782_2021-07-03T11-24-37Z.jpg")
+    # added in reverse order, the messages are sorted by index
+    for index in reversed(range(n_flowers)):
+        message_generator.add_flower(Flower(index, "daisy", 0.91234, 120, 80))
+    for index in reversed(range(n_pollinators)):
+        message_generator.add_pollinator(
+            Pollinator(
+                index, index % max(n_flowers, 1), "honigbiene", 0.5678, 20, 10,
+                Image.new("RGB", (20, 10), (index * 40, 100, 50)),
+            )
+        )
+    return message_generator
+
+
+@pytest.mark.parametrize("n_flowers, n_pollinators", [(0, 0), (2, 0), (2, 3)])
+@pytest.mark.parametrize("save_crop", [True, False])
+def test_dumps_message_equals_generate_message(n_flowers, n_pollinators, save_crop):
+    message_generator = _message_generator(n_flowers, n_pollinators)
+    message = message_generator.dumps_message(save_crop=save_crop)
+    assert message == json.dumps(message_generator.generate_message(save_crop=save_crop))
+    assert json.loads(message)["metadata"]["node_id"] == "0344-6782"
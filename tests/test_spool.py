@@ -0,0 +1,38 @@
+import os
+import sys
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "src", "pipeline", "Pollinatordetection")
+)
+from spool import ResultSpool, SpoolSender  # noqa: E402
+
+
+def test_compact_shrinks_drained_spool(tmp_path):
+    path = str(tmp_path / "spool.sqlite")
+    spool = ResultSpool(path)
+    for i in range(2000):
+        spool.put("http", "x" * 1000, filename=f"image_{i}", node_id="node")
+    spool.compact()
+    full_size = os.path.getsize(path)
+
+    while spool.count("http") > 0:
+        spool.ack([row[0] for row in spool.get_due("http", 500)])
+    spool.compact()
+
+    assert spool._conn().execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+    assert os.path.getsize(path) < full_size / 10
+    spool.close()
+
+
+def test_untried_results_keep_their_attempts(tmp_path):
+    spool = ResultSpool(str(tmp_path / "spool.sqlite"))
+    for i in range(3):
+        spool.put("http", "{}", filename=f"image_{i}")
+    sender = SpoolSender(spool, {"http": lambda rows: [True, False, None]})
+    sender._drain("http", sender.senders["http"])
+
+    attempts = spool._conn().execute("SELECT filename, attempts FROM results ORDER BY id").fetchall()
+    assert attempts == [("image_1", 1), ("image_2", 0)]
+    # the untried result is still due
+    assert [row[1] for row in spool.get_due("http", 10)] == ["image_2"]
+    spool.close()
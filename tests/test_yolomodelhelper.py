@@ -0,0 +1,60 @@
+import os
+import sys
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("torch")
+pytest.importorskip("PIL")
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "src", "pipeline", "Pollinatordetection")
+)
+from yolomodelhelper import compute_iou_matrix, group_overlapping  # noqa: E402
+
+
+def test_compute_iou_matrix():
+    boxes = np.array([
+        [0, 0, 10, 10],
+        [5, 0, 15, 10],
+        [20, 20, 30, 30],
+        [0, 0, 10, 10],
+    ])
+    iou = compute_iou_matrix(boxes)
+    assert iou.shape == (4, 4)
+    np.testing.assert_allclose(np.diag(iou), 1)
+    np.testing.assert_allclose(iou, iou.T)
+    # 50 / (100 + 100 - 50)
+    assert iou[0, 1] == pytest.approx(1 / 3)
+    assert iou[0, 2] == 0
+    assert iou[0, 3] == 1
+
+
+def test_compute_iou_matrix_empty_boxes():
+    iou = compute_iou_matrix(np.array([[0, 0, 0, 0], [0, 0, 0, 0]]))
+    np.testing.assert_array_equal(iou, 0)
+
+
+def test_group_overlapping_chain():
+    # A overlaps B, B overlaps C, A and C do not overlap: one group
+    boxes = np.array([
+        [0, 0, 10, 10],
+        [6, 0, 16, 10],
+        [12, 0, 22, 10],
+        [50, 50, 60, 60],
+    ])
+    iou = compute_iou_matrix(boxes)
+    overlapping = iou > 0.1
+    assert not overlapping[0, 2]
+    assert group_overlapping(overlapping) == [0, 0, 0, 1]
+
+
+def test_group_overlapping_connected_components():
+    edges = [(0, 6), (1, 2), (1, 3), (1, 4), (1, 5), (2, 4), (2, 6), (4, 5)]
+    overlapping = np.eye(8, dtype=bool)
+    for i, j in edges:
+        overlapping[i, j] = overlapping[j, i] = True
+    # groups are numbered in the order of their first object
+    assert group_overlapping(overlapping) == [0, 0, 0, 0, 0, 0, 0, 1]
+    assert group_overlapping(np.eye(3, dtype=bool)) == [0, 1, 2]
+    assert group_overlapping(np.zeros((0, 0), dtype=bool)) == []